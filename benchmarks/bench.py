@@ -0,0 +1,239 @@
+# Benchmarks for the main esprit operations, run against the stand-in server in fakees.py so that
+# they need no ElasticSearch and no network.  For each operation it reports the throughput, the
+# latency percentiles of the HTTP requests it made, and the peak memory used.  Run it with
+#
+#     python benchmarks/bench.py --docs 10000 --latency 0.002
+#
+# and see --help for the rest of the options.  Peak memory is measured with tracemalloc where
+# there is one (python 3), in a second run of the operation so that tracing doesn't slow the
+# timed run, and includes whatever the server thread allocates along the way.  Without
+# tracemalloc it is the growth in the process's maximum resident size, which is coarse
+
+import os, sys, time, json, argparse, resource
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from esprit import raw, tasks, dao
+from fakees import FakeElasticSearch
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+INDEX = "bench"
+TYPE = "record"
+
+def make_records(n, size=200):
+    # ids are zero padded so that they sort in the same order as they are numbered
+    padding = "x" * size
+    return [{"id" : "%09d" % i, "title" : "record " + str(i), "category" : "c" + str(i % 10),
+             "number" : i, "text" : padding} for i in range(n)]
+
+class Timings(object):
+    """
+    A Connection hook which keeps the time of every request, for exact percentiles
+    """
+    def __init__(self):
+        self.seconds = []
+
+    def after_request(self, event):
+        self.seconds.append(event["seconds"])
+
+    def percentile(self, p):
+        if len(self.seconds) == 0:
+            return 0.0
+        ordered = sorted(self.seconds)
+        i = int(round((len(ordered) - 1) * p / 100.0))
+        return ordered[i]
+
+class Record(dao.DomainObject):
+    __type__ = TYPE
+
+class Bench(object):
+    """
+    What the operations run against: the server, a connection to it, and the options
+    """
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.timings = Timings()
+        self.conn = raw.Connection("127.0.0.1", INDEX, port=server.port, pool_maxsize=max(10, args.workers or 1),
+                                   hooks=[self.timings], compression=args.compression)
+        self.records = make_records(args.docs, args.doc_size)
+
+    def fill(self):
+        self.server.store.docs.pop(INDEX, None)
+        self.server.load(INDEX, TYPE, self.records)
+
+    def empty(self):
+        self.server.store.docs.pop(INDEX, None)
+        self.server.store.docs.pop(INDEX + "_copy", None)
+
+##################################################################
+## The operations.  Each is given the Bench, and returns the number of records (or requests) it
+## handled; setup is done beforehand and isn't timed
+
+def bulk(b):
+    for i in range(0, len(b.records), b.args.batch):
+        raw.bulk(b.conn, TYPE, b.records[i:i + b.args.batch])
+    return len(b.records)
+
+def bulk_indexer(b):
+    raw.BulkIndexer(b.conn, TYPE, max_docs=b.args.batch).index(b.records)
+    return len(b.records)
+
+def scroll(b):
+    return sum(1 for _ in tasks.scroll(b.conn, TYPE, page_size=b.args.batch, slices=b.args.slices,
+                                       workers=b.args.workers))
+
+def iterate(b):
+    return sum(1 for _ in tasks.iterate(b.conn, TYPE, {"query" : {"match_all" : {}}}, page_size=b.args.batch))
+
+def copy(b):
+    target = raw.Connection("127.0.0.1", INDEX + "_copy", port=b.server.port, hooks=[b.timings])
+    stats = tasks.copy(b.conn, TYPE, target, TYPE, batch_size=b.args.batch, workers=b.args.workers)
+    return stats.written
+
+def query(b):
+    for i in range(b.args.repeat):
+        Record.query(terms={"category" : ["c" + str(i % 10)]}, size=10, conn=b.conn, use_cache=False)
+    return b.args.repeat
+
+def mget(b):
+    ids = [r["id"] for r in b.records]
+    for i in range(0, len(ids), b.args.batch):
+        raw.mget(b.conn, TYPE, ids[i:i + b.args.batch])
+    return len(ids)
+
+def get(b):
+    for i in range(b.args.repeat):
+        raw.get(b.conn, TYPE, b.records[i % len(b.records)]["id"])
+    return b.args.repeat
+
+def put(b):
+    for i in range(b.args.repeat):
+        r = b.records[i % len(b.records)]
+        raw.store(b.conn, TYPE, r, r["id"])
+    return b.args.repeat
+
+def delete(b):
+    for i in range(b.args.repeat):
+        raw.delete(b.conn, TYPE, b.records[i % len(b.records)]["id"])
+    return b.args.repeat
+
+def mapping(b):
+    for i in range(b.args.repeat):
+        raw.put_mapping(b.conn, TYPE, {TYPE : {"properties" : {"number" : {"type" : "long"}}}}, es_version="2.4.6")
+        raw.get_mapping(b.conn, TYPE, es_version="2.4.6")
+    return b.args.repeat * 2
+
+def refresh(b):
+    for i in range(b.args.repeat):
+        raw.refresh(b.conn)
+    return b.args.repeat
+
+# name, function, and whether it needs the records in the index first
+OPERATIONS = [
+    ("bulk", bulk, False),
+    ("bulk_indexer", bulk_indexer, False),
+    ("scroll", scroll, True),
+    ("iterate", iterate, True),
+    ("copy", copy, True),
+    ("query", query, True),
+    ("mget", mget, True),
+    ("get", get, True),
+    ("put", put, False),
+    ("delete", delete, True),
+    ("mapping", mapping, False),
+    ("refresh", refresh, False),
+]
+
+##################################################################
+## Running them
+
+def _prepare(b, needs_data):
+    b.empty()
+    if needs_data:
+        b.fill()
+
+def peak_memory(b, fn, needs_data):
+    _prepare(b, needs_data)
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            fn(b)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn(b)
+    # ru_maxrss is in kilobytes on linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024
+
+def run(b, name, fn, needs_data):
+    _prepare(b, needs_data)
+    b.timings.seconds = []
+    start = time.time()
+    count = fn(b)
+    elapsed = time.time() - start
+    requests = len(b.timings.seconds)
+    result = {
+        "operation" : name,
+        "count" : count,
+        "seconds" : elapsed,
+        "per_second" : count / elapsed if elapsed > 0 else 0.0,
+        "requests" : requests,
+        "p50" : b.timings.percentile(50),
+        "p95" : b.timings.percentile(95),
+        "p99" : b.timings.percentile(99),
+        "max" : max(b.timings.seconds) if requests > 0 else 0.0,
+    }
+    result["peak_memory"] = peak_memory(b, fn, needs_data) if b.args.memory else None
+    return result
+
+def report(results):
+    header = "{0:<14}{1:>9}{2:>10}{3:>12}{4:>10}{5:>10}{6:>10}{7:>10}{8:>12}".format(
+        "operation", "count", "seconds", "per second", "requests", "p50 ms", "p95 ms", "p99 ms", "peak MiB")
+    lines = [header, "-" * len(header)]
+    for r in results:
+        memory = "{0:.1f}".format(r["peak_memory"] / 1048576.0) if r["peak_memory"] is not None else "-"
+        lines.append("{0:<14}{1:>9}{2:>10.3f}{3:>12.1f}{4:>10}{5:>10.2f}{6:>10.2f}{7:>10.2f}{8:>12}".format(
+            r["operation"], r["count"], r["seconds"], r["per_second"], r["requests"],
+            r["p50"] * 1000, r["p95"] * 1000, r["p99"] * 1000, memory))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    names = [n for n, _, _ in OPERATIONS]
+    parser = argparse.ArgumentParser(description="benchmark esprit against a local stand-in ElasticSearch")
+    parser.add_argument("-d", "--docs", type=int, default=10000, help="number of records in the dataset")
+    parser.add_argument("-s", "--doc-size", type=int, default=200, help="bytes of padding text in each record")
+    parser.add_argument("-b", "--batch", type=int, default=1000, help="page and bulk batch size")
+    parser.add_argument("-r", "--repeat", type=int, default=200, help="number of calls for the single-request operations")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="seconds the server holds each request for")
+    parser.add_argument("-j", "--jitter", type=float, default=0.0, help="fraction by which the latency varies")
+    parser.add_argument("-w", "--workers", type=int, help="workers for copy and sliced scroll")
+    parser.add_argument("-n", "--slices", type=int, help="scroll with this many slices")
+    parser.add_argument("-z", "--compression", choices=raw.COMPRESSIONS, help="compress request bodies")
+    parser.add_argument("-m", "--no-memory", dest="memory", action="store_false", help="skip the peak memory runs")
+    parser.add_argument("-o", "--output", help="also write the results as json to this file")
+    parser.add_argument("operations", nargs="*", help="operations to run, from " + ", ".join(names) + " (default all)")
+    args = parser.parse_args()
+    unknown = [o for o in args.operations if o not in names]
+    if len(unknown) > 0:
+        parser.error("unknown operations: " + ", ".join(unknown))
+
+    server = FakeElasticSearch(latency=args.latency, jitter=args.jitter).start()
+    try:
+        b = Bench(server, args)
+        results = []
+        for name, fn, needs_data in OPERATIONS:
+            if len(args.operations) > 0 and name not in args.operations:
+                continue
+            results.append(run(b, name, fn, needs_data))
+        print(report(results))
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump({"options" : vars(args), "results" : results}, f, indent=2)
+    finally:
+        server.stop()
@@ -0,0 +1,404 @@
+# A stand-in ElasticSearch server for benchmarking esprit offline.  It runs in a thread of the
+# calling process and speaks just enough of the HTTP API for esprit: documents by id, _search
+# (with scroll, slices, from/size and search_after), _search/scroll, _bulk, _mget, _mapping,
+# _refresh, _query and the root version info.  Queries are understood only as far as match_all,
+# query_string (which matches everything), term(s), ids and bool; sorting is by source fields.
+# Every response can be delayed by a fixed latency, to stand in for the network and the cluster
+
+import json, threading, time, random, zlib, itertools, functools, socket
+from collections import OrderedDict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+
+VERSION = "2.4.6"
+
+class Store(object):
+    """
+    The documents, mappings and open scrolls of every index on the server
+    """
+    def __init__(self):
+        self.docs = {}          # index -> type -> id -> source
+        self.mappings = {}      # index -> type -> mapping
+        self.scrolls = {}       # scroll id -> (hits, offset, size)
+        self.lock = threading.Lock()
+        self._scroll_ids = itertools.count()
+
+    def types(self, index, types):
+        names = types if types else list(self.docs.get(index, {}).keys())
+        return [(t, self.docs.get(index, {}).get(t, {})) for t in names]
+
+    def put(self, index, type, id, source):
+        with self.lock:
+            self.docs.setdefault(index, {}).setdefault(type, {})[id] = source
+            self.mappings.setdefault(index, {})
+
+    def get(self, index, type, id):
+        return self.docs.get(index, {}).get(type, {}).get(id)
+
+    def delete(self, index, type, id):
+        with self.lock:
+            return self.docs.get(index, {}).get(type, {}).pop(id, None) is not None
+
+    def search(self, index, types, query):
+        hits = []
+        for t, docs in self.types(index, types):
+            for id, source in list(docs.items()):
+                if matches(id, source, query.get("query")):
+                    hits.append((t, id, source))
+        keys = sort_keys(query.get("sort"))
+        def compare(a, b):
+            for field, order in keys:
+                va, vb = sort_value(a, field), sort_value(b, field)
+                if va != vb:
+                    c = -1 if va < vb else 1
+                    return -c if order == "desc" else c
+            return 0
+        hits.sort(key=functools.cmp_to_key(compare))
+        return [(h, [sort_value(h, k) for k, _ in keys]) for h in hits]
+
+    def open_scroll(self, hits, size):
+        # the first page goes back with the search that opens the scroll
+        with self.lock:
+            sid = "scroll" + str(next(self._scroll_ids))
+            self.scrolls[sid] = (hits, size, size)
+        return sid
+
+    def next_page(self, sid):
+        with self.lock:
+            if sid not in self.scrolls:
+                return None
+            hits, offset, size = self.scrolls[sid]
+            self.scrolls[sid] = (hits, offset + size, size)
+        return hits[offset:offset + size]
+
+    def clear_scroll(self, sid):
+        with self.lock:
+            return self.scrolls.pop(sid, None) is not None
+
+def matches(id, source, q):
+    if q is None or "match_all" in q or "query_string" in q:
+        return True
+    if "ids" in q:
+        return id in q["ids"].get("values", [])
+    if "term" in q or "terms" in q:
+        clause = q.get("term") or q.get("terms")
+        for field, value in clause.items():
+            if isinstance(value, dict):
+                value = value.get("value")
+            values = value if isinstance(value, list) else [value]
+            have = source.get(field)
+            have = have if isinstance(have, list) else [have]
+            if not set([str(v) for v in have]) & set([str(v) for v in values]):
+                return False
+        return True
+    if "bool" in q:
+        b = q["bool"]
+        for key in ["must", "filter"]:
+            clauses = b.get(key, [])
+            clauses = clauses if isinstance(clauses, list) else [clauses]
+            if not all([matches(id, source, c) for c in clauses]):
+                return False
+        not_clauses = b.get("must_not", [])
+        not_clauses = not_clauses if isinstance(not_clauses, list) else [not_clauses]
+        return not any([matches(id, source, c) for c in not_clauses])
+    if "constant_score" in q:
+        return matches(id, source, q["constant_score"].get("filter"))
+    # anything else is beyond this server, so let it through
+    return True
+
+def sort_keys(sort):
+    if sort is None:
+        return [("_id", "asc")]
+    if not isinstance(sort, list):
+        sort = [sort]
+    keys = []
+    for s in sort:
+        if isinstance(s, dict):
+            field = list(s.keys())[0]
+            order = s[field].get("order", "asc") if isinstance(s[field], dict) else s[field]
+            keys.append((field, order))
+        else:
+            keys.append((s, "asc"))
+    return keys
+
+def sort_value(hit, field):
+    type, id, source = hit
+    if field == "_id":
+        return id
+    value = source.get(field)
+    return value if value is not None else ""
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # the headers and body go in separate writes, which Nagle's algorithm would hold up
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length > 0 else b""
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = zlib.decompress(body, 31)
+        elif encoding == "deflate":
+            body = zlib.decompress(body)
+        return body
+
+    def send(self, status, obj=None, method="GET"):
+        body = json.dumps(obj).encode("utf-8") if obj is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if method != "HEAD":
+            self.wfile.write(body)
+
+    def handle_request(self, method):
+        body = self.read_body()
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency * (1 + random.uniform(-server.jitter, server.jitter)))
+        server.requests += 1
+
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        parts = [p for p in url.path.split("/") if p]
+        try:
+            if body and not url.path.endswith("_bulk"):
+                q = json.loads(body.decode("utf-8"))
+            else:
+                # searches made with GET carry the query in the url
+                q = json.loads(params["source"]) if "source" in params else {}
+        except ValueError:
+            return self.send(400, {"error" : "could not parse body"}, method)
+
+        status, obj = self.route(method, parts, params, q, body)
+        self.send(status, obj, method)
+
+    def route(self, method, parts, params, q, body):
+        store = self.server.store
+        if len(parts) == 0:
+            return 200, {"version" : {"number" : VERSION}, "tagline" : "You Know, for Search"}
+
+        # scrolls are addressed without an index
+        if parts[0] == "_search" and len(parts) > 1 and parts[1] == "scroll":
+            sid = parts[2] if len(parts) > 2 else params.get("scroll_id", q.get("scroll_id"))
+            if method == "DELETE":
+                found = store.clear_scroll(sid)
+                return (200 if found else 404), {"succeeded" : found}
+            page = store.next_page(sid)
+            if page is None:
+                return 404, {"error" : "SearchContextMissingException[No search context found for id]", "status" : 404}
+            return 200, search_result(page, sid)
+
+        index = parts[0]
+        rest = parts[1:]
+        endpoint = None
+        for i, p in enumerate(rest):
+            if p.startswith("_"):
+                endpoint = p
+                names = rest[:i] + rest[i + 1:]
+                break
+        types = rest[0].split(",") if len(rest) > 0 and not rest[0].startswith("_") else []
+
+        if endpoint == "_search":
+            hits = store.search(index, types, q)
+            if "slice" in q:
+                s = q["slice"]
+                hits = [h for n, h in enumerate(hits) if n % s["max"] == s["id"]]
+            size = int(q.get("size", params.get("size", 10)))
+            if "scroll" in params:
+                sid = store.open_scroll(hits, size)
+                return 200, search_result(hits[:size], sid, total=len(hits))
+            if "search_after" in q:
+                after = q["search_after"]
+                hits = [h for h in hits if h[1] > after]
+            offset = int(q.get("from", 0))
+            return 200, search_result(hits[offset:offset + size], total=len(hits))
+        if endpoint == "_bulk":
+            return 200, self.bulk(index, types[0] if types else None, body)
+        if endpoint == "_mget":
+            docs = q.get("docs") or [{"_id" : id} for id in q.get("ids", [])]
+            out = []
+            for d in docs:
+                t = d.get("_type") or (types[0] if types else None)
+                source = store.get(index, t, d["_id"])
+                if source is None:
+                    out.append({"_index" : index, "_type" : t, "_id" : d["_id"], "found" : False})
+                else:
+                    out.append({"_index" : index, "_type" : t, "_id" : d["_id"], "found" : True, "_source" : source})
+            return 200, {"docs" : out}
+        if endpoint == "_mapping":
+            mapped = [n for n in names if n != "_mapping"]
+            if method == "PUT":
+                with store.lock:
+                    for t in mapped:
+                        store.mappings.setdefault(index, {})[t] = q
+                return 200, {"acknowledged" : True}
+            if index not in store.mappings:
+                return 404, {"error" : "IndexMissingException[[" + index + "] missing]", "status" : 404}
+            if len(mapped) > 0 and mapped[0] not in store.mappings[index]:
+                return 404, {}
+            return 200, {index : {"mappings" : store.mappings[index]}}
+        if endpoint == "_refresh":
+            return 200, {"_shards" : {"total" : 1, "successful" : 1, "failed" : 0}}
+        if endpoint == "_query" and method == "DELETE":
+            hits = store.search(index, types, q if "query" in q else {"query" : q})
+            for (t, id, source), _ in hits:
+                store.delete(index, t, id)
+            return 200, {"_indices" : {index : {"_shards" : {"total" : 1, "successful" : 1, "failed" : 0}}}}
+        if endpoint is not None:
+            return 400, {"error" : "unsupported endpoint " + endpoint}
+
+        if len(rest) == 0:
+            # the index itself
+            if method in ["PUT", "POST"]:
+                with store.lock:
+                    store.mappings.setdefault(index, {})
+                    store.docs.setdefault(index, {})
+                return 200, {"acknowledged" : True}
+            if method == "DELETE":
+                with store.lock:
+                    store.mappings.pop(index, None)
+                    store.docs.pop(index, None)
+                return 200, {"acknowledged" : True}
+            return (200 if index in store.mappings else 404), {}
+        if len(rest) == 1:
+            if method == "POST":
+                id = "%032x" % random.getrandbits(128)
+                store.put(index, rest[0], id, q)
+                return 201, {"_index" : index, "_type" : rest[0], "_id" : id, "created" : True}
+            exists = rest[0] in store.docs.get(index, {}) or rest[0] in store.mappings.get(index, {})
+            return (200 if exists else 404), {}
+
+        type, id = rest[0], rest[1]
+        if method in ["PUT", "POST"]:
+            store.put(index, type, id, q)
+            return 201, {"_index" : index, "_type" : type, "_id" : id, "_version" : 1, "created" : True}
+        if method == "DELETE":
+            found = store.delete(index, type, id)
+            return (200 if found else 404), {"_index" : index, "_type" : type, "_id" : id, "found" : found}
+        source = store.get(index, type, id)
+        if source is None:
+            return 404, {"_index" : index, "_type" : type, "_id" : id, "found" : False}
+        return 200, {"_index" : index, "_type" : type, "_id" : id, "_version" : 1, "found" : True, "_source" : source}
+
+    def bulk(self, index, type, body):
+        store = self.server.store
+        lines = [l for l in body.decode("utf-8").split("\n") if l.strip()]
+        items = []
+        i = 0
+        while i < len(lines):
+            action_line = json.loads(lines[i])
+            action = list(action_line.keys())[0]
+            meta = action_line[action]
+            t = meta.get("_type", type)
+            id = meta.get("_id")
+            if action == "delete":
+                found = store.delete(index, t, id)
+                items.append({action : {"_index" : index, "_type" : t, "_id" : id, "status" : 200 if found else 404, "found" : found}})
+                i += 1
+                continue
+            source = json.loads(lines[i + 1])
+            i += 2
+            if id is None:
+                id = "%032x" % random.getrandbits(128)
+            if action == "update":
+                existing = store.get(index, t, id)
+                if existing is None:
+                    items.append({action : {"_index" : index, "_type" : t, "_id" : id, "status" : 404,
+                                            "error" : "DocumentMissingException"}})
+                    continue
+                merged = dict(existing)
+                merged.update(source.get("doc", {}))
+                source = merged
+            store.put(index, t, id, source)
+            items.append({action : {"_index" : index, "_type" : t, "_id" : id, "_version" : 1, "status" : 201}})
+        return {"took" : 1, "errors" : any(["error" in list(it.values())[0] for it in items]), "items" : items}
+
+def search_result(hits, scroll_id=None, total=None):
+    # ElasticSearch writes the scroll id first, before took
+    result = OrderedDict()
+    if scroll_id is not None:
+        result["_scroll_id"] = scroll_id
+    result["took"] = 1
+    result["timed_out"] = False
+    result["hits"] = {
+        "total" : total if total is not None else len(hits),
+        "hits" : [{"_index" : "", "_type" : t, "_id" : id, "_score" : 1.0, "_source" : source, "sort" : sort}
+                  for (t, id, source), sort in hits]
+    }
+    return result
+
+class FakeElasticSearch(ThreadingMixIn, HTTPServer):
+    """
+    The server, listening on localhost.  latency is the time (in seconds) each request is held
+    for, varied by up to +/- jitter of itself
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.store = Store()
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-elasticsearch")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def load(self, index, type, records, idkey="id"):
+        # fill an index directly, without going through http
+        for r in records:
+            self.store.put(index, type, r[idkey], r)
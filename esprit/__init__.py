@@ -1 +1 @@
-import mappings, models, raw, dao, util, tasks
+from esprit import mappings, models, raw, dao, util, tasks, cache, codec, metrics, export
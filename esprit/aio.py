@@ -0,0 +1,368 @@
+# Asyncio equivalents of the raw ElasticSearch functions, for use from inside an event loop.
+# Needs python 3 and aiohttp.  URLs are built, and responses unpacked, by the functions in raw,
+# so the two modules stay in step
+
+import time, asyncio
+from esprit import raw, tasks
+from esprit.models import QueryBuilder
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+##################################################################
+## Connection to the index
+
+class Connection(raw.Connection):
+    """
+    A raw.Connection whose pool is an aiohttp session, so that any number of concurrent requests
+    from one event loop share pool_maxsize keep-alive connections per host.  Use it with
+    "async with", or await close() when finished
+    """
+    def __init__(self, host, index, port=9200, auth=None, verify_ssl=True,
+                 pool_connections=10, pool_maxsize=10, pool_block=True, keep_alive=True, timeout=None, codec=None,
+                 compression=None, compression_threshold=1024, compression_level=6, accept_compression=True,
+                 selector=None, dead_timeout=60, retry=None, hooks=None, keepalive_timeout=15, es_version=None):
+        if aiohttp is None:
+            raise raw.ESWireException("esprit.aio needs aiohttp to be installed")
+        self.keepalive_timeout = keepalive_timeout
+        super(Connection, self).__init__(host, index, port, auth, verify_ssl,
+                                         pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                         pool_block=pool_block, keep_alive=keep_alive, timeout=timeout, codec=codec,
+                                         compression=compression, compression_threshold=compression_threshold,
+                                         compression_level=compression_level, accept_compression=accept_compression,
+                                         selector=selector, dead_timeout=dead_timeout, health_check_interval=None,
+                                         retry=retry, hooks=hooks, es_version=es_version)
+
+    def _init_pool(self):
+        self._session = None
+        self._closed = False
+
+    def session(self):
+        if self._closed:
+            raise raw.ESWireException("connection to '" + str(self.host) + "' has been closed")
+        if self._session is None:
+            # aiohttp always waits for a free connection once the limits are reached, so pool_block
+            # has no effect here
+            connector = aiohttp.TCPConnector(limit=self.pool_connections * self.pool_maxsize,
+                                             limit_per_host=self.pool_maxsize,
+                                             force_close=not self.keep_alive,
+                                             keepalive_timeout=self.keepalive_timeout if self.keep_alive else None,
+                                             ssl=None if self.verify_ssl else False)
+            auth = aiohttp.BasicAuth(*self.auth) if self.auth is not None else None
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+            headers = {"Accept-Encoding" : "identity"} if not self.accept_compression else None
+            self._session = aiohttp.ClientSession(connector=connector, auth=auth, timeout=timeout, headers=headers)
+        return self._session
+
+    async def close(self):
+        self._closed = True
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def __getstate__(self):
+        state = super(Connection, self).__getstate__()
+        del state["_session"]
+        return state
+
+class Response(object):
+    """
+    The body and status of a completed request, with enough of the requests.Response interface
+    that the raw.unpack_* functions can be used on it
+    """
+    def __init__(self, status_code, content, headers, codec):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.codec = codec
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return self.codec.loads(self.content)
+
+###############################################################
+## HTTP Requests
+
+async def _do_request(method, url, conn, data=None, headers=None):
+    if not conn.hooks:
+        return await _send_request(method, url, conn, data, headers)
+
+    endpoint, index, doc_type = raw.describe_url(conn, url)
+    event = {"method" : method, "url" : url, "endpoint" : endpoint, "index" : index, "type" : doc_type,
+             "bytes_sent" : len(data) if data is not None else 0}
+    raw._fire(conn.hooks, "before_request", event)
+    start = time.time()
+    try:
+        response = await _send_request(method, url, conn, data, headers)
+    except Exception as e:
+        event.update({"status" : None, "bytes_received" : None, "seconds" : time.time() - start,
+                      "took" : None, "attempts" : None, "error" : e})
+        raw._fire(conn.hooks, "after_request", event)
+        raise
+
+    event["seconds"] = time.time() - start
+    event["status"] = response.status_code
+    event["attempts"] = response.attempts
+    event["error"] = None
+    if response.compression is not None and response.compression.get("encoding") is not None:
+        event["bytes_sent"] = response.compression["sent"]
+    wire_length = response.headers.get("Content-Length")
+    event["bytes_received"] = int(wire_length) if wire_length is not None else len(response.content)
+    event["took"] = raw.response_took(response.content)
+    raw._fire(conn.hooks, "after_request", event)
+    return response
+
+async def _send_request(method, url, conn, data, headers):
+    record = None
+    if data is not None:
+        data, record = raw.compress_body(conn, data)
+        if record is not None:
+            headers = dict(headers or {})
+            headers["Content-Encoding"] = record["encoding"]
+
+    policy = conn.retry
+    attempt = 1
+    while True:
+        if conn.multi_node:
+            response = await _do_node_request(method, url, conn, data, headers)
+        else:
+            response = await _send(method, url, conn, data, headers)
+        if policy is None or response.status_code not in policy.statuses:
+            break
+        if attempt >= policy.max_attempts:
+            policy.record(gave_up=1)
+            break
+        delay = policy.delay(attempt, response.headers.get("Retry-After"))
+        policy.record(retries=1, waited=delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+    response.attempts = attempt
+
+    # aiohttp has already decompressed the body, so Content-Length is what came over the wire
+    response_encoding = response.headers.get("Content-Encoding")
+    wire_length = response.headers.get("Content-Length")
+    if response_encoding in raw.COMPRESSIONS and wire_length is not None:
+        record = record if record is not None else {"encoding" : None}
+        record["response_encoding"] = response_encoding
+        record["received"] = int(wire_length)
+        record["decoded"] = len(response.content)
+    response.compression = record
+    if record is not None:
+        conn.compression_stats.add(record)
+    return response
+
+async def _send(method, url, conn, data, headers):
+    # the url is already encoded by raw.elasticsearch_url, so stop aiohttp from requoting it
+    async with conn.session().request(method, yarl.URL(url, encoded=True), data=data, headers=headers) as resp:
+        content = await resp.read()
+        return Response(resp.status, content, resp.headers, raw.get_codec(conn))
+
+async def _do_node_request(method, url, conn, data, headers):
+    # as raw._do_node_request, except that dead nodes are only revived by their dead_timeout
+    # running out, as there is no background health check
+    base = raw.node_url(conn.host, conn.port)
+    path = url[len(base):] if url.startswith(base) else None
+    attempts = 0
+    while True:
+        node = conn.select_node()
+        try:
+            result = await _send(method, node.url + path if path is not None else url, conn, data, headers)
+        except aiohttp.ClientConnectionError:
+            conn.mark_dead(node)
+            attempts += 1
+            if path is None or attempts >= len(conn.nodes):
+                raise
+            continue
+        finally:
+            conn.release_node(node)
+        conn.mark_alive(node)
+        return result
+
+###############################################################
+## Regular Search
+
+async def search(connection, type=None, query=None, method="POST", url_params=None):
+    url = raw.elasticsearch_url(connection, type, "_search", url_params)
+
+    if query is None:
+        query = QueryBuilder.match_all()
+    if not isinstance(query, dict):
+        query = QueryBuilder.query_string(query)
+
+    resp = None
+    if method == "POST":
+        headers = {"content-type" : "application/json"}
+        resp = await _do_request("POST", url, connection, data=raw.get_codec(connection).dumpb(query), headers=headers)
+    elif method == "GET":
+        resp = await _do_request("GET", url + "?source=" + raw.quote_plus(raw.get_codec(connection).dumps(query)), connection)
+    return resp
+
+#################################################################
+## Scroll search
+
+async def initialise_scroll(connection, type=None, query=None, keepalive="10m"):
+    return await search(connection, type, query, url_params={"scroll" : keepalive})
+
+async def scroll_next(connection, scroll_id, keepalive="10m"):
+    url = raw.elasticsearch_url(connection, endpoint="_search/scroll", params={"scroll_id" : scroll_id, "scroll" : keepalive}, omit_index=True)
+    return await _do_request("GET", url, connection)
+
+async def clear_scroll(connection, scroll_id):
+    url = raw.elasticsearch_url(connection, endpoint="_search/scroll/" + scroll_id, omit_index=True)
+    return await _do_request("DELETE", url, connection)
+
+async def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m"):
+    """
+    Async generator over all the records matching the query, with the same keepalive options,
+    scroll registry and clean-up behaviour as tasks.scroll
+    """
+    if q is not None:
+        q = q.copy()
+    if q is None:
+        q = {"query" : {"match_all" : {}}}
+    if "size" not in q:
+        q["size"] = page_size
+    if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
+        q["sort"] = [{"id" : {"order" : "asc"}}]
+    if keepalive == tasks.KEEPALIVE_AUTO:
+        keepalive = tasks.AdaptiveKeepalive()
+
+    resp = await initialise_scroll(conn, type, q, str(keepalive))
+    if resp.status_code != 200:
+        # something went wrong initialising the scroll
+        raise tasks.ScrollException("Unable to initialise scroll - could be your mappings are broken")
+
+    results, scroll_id = raw.unpack_scroll(resp)
+    idle_since = time.time()
+    token = tasks.scroll_registry.register(conn, type, scroll_id, str(keepalive))
+    counter = 0
+    try:
+        while True:
+            for r in results:
+                # apply the limit
+                if limit is not None and counter >= int(limit):
+                    return
+                counter += 1
+                yield r
+            # apply the limit (again), so that we don't ask for a page we won't use
+            if limit is not None and counter >= int(limit):
+                return
+
+            # the context has been idle since the last page came back; that's what the keepalive has to cover
+            if isinstance(keepalive, tasks.AdaptiveKeepalive):
+                keepalive.observe(time.time() - idle_since)
+            sresp = await scroll_next(conn, scroll_id, keepalive=str(keepalive))
+            if raw.scroll_timedout(sresp):
+                scroll_id = None    # the context has already gone, so there is nothing to clear
+                raise tasks.ScrollException("scroll timed out - you probably need to raise the keepalive value")
+            if sresp.status_code != 200:
+                # anything else would read as an empty page, and end the scroll early
+                raise tasks.ScrollException("scroll failed with status " + str(sresp.status_code) + ": " + sresp.text)
+            results, scroll_id = raw.unpack_scroll(sresp)
+            idle_since = time.time()
+            tasks.scroll_registry.update(token, scroll_id, str(keepalive))
+            if len(results) == 0:
+                return
+    finally:
+        tasks.scroll_registry.unregister(token)
+        if scroll_id is not None:
+            try:
+                await clear_scroll(conn, scroll_id)
+            except Exception:
+                # don't hide whatever brought us here; the context will time out eventually
+                pass
+
+async def server_version(conn):
+    """
+    As raw.server_version
+    """
+    if conn.es_version is not None:
+        return conn.es_version
+    if conn.metadata.version is None:
+        version = raw.DEFAULT_ES_VERSION
+        resp = await _do_request("GET", raw.node_url(conn.host, conn.port) + "/", conn)
+        if resp.status_code == 200:
+            version = resp.json().get("version", {}).get("number", version)
+        conn.metadata.version = version
+    return conn.metadata.version
+
+async def iterate(conn, type, q, page_size=1000, limit=None, method="POST", paging=None):
+    """
+    Async generator which pages through the records matching the query in the same way as
+    tasks.iterate
+    """
+    if paging is None:
+        paging = tasks.paging_for_version(await server_version(conn))
+    q = tasks._paging_query(q, page_size, paging)
+
+    counter = 0
+    while True:
+        resp = await search(conn, type=type, query=q, method=method)
+        if resp.status_code != 200:
+            raise raw.ESWireException("search failed with status " + str(resp.status_code) + ": " + resp.text)
+        hits = resp.json().get("hits", {}).get("hits", [])
+        if len(hits) == 0:
+            return
+        for h in hits:
+            # apply the limit
+            if limit is not None and counter >= int(limit):
+                return
+            counter += 1
+            yield raw.unpack_hit(h)
+        # apply the limit (again)
+        if limit is not None and counter >= int(limit):
+            return
+        if paging == tasks.PAGING_SEARCH_AFTER:
+            q["search_after"] = hits[-1].get("sort")
+        else:
+            q["from"] += page_size
+
+#################################################################
+## Record retrieval
+
+async def get(connection, type, id):
+    url = raw.elasticsearch_url(connection, type, endpoint=id)
+    return await _do_request("GET", url, connection)
+
+async def mget(connection, type, ids, fields=None):
+    url, docs = raw.mget_request(connection, type, ids, fields)
+    return await _do_request("POST", url, connection, data=raw.get_codec(connection).dumpb(docs))
+
+############################################################
+## Store records
+
+async def store(connection, type, record, id=None, params=None):
+    url = raw.elasticsearch_url(connection, type, endpoint=id, params=params)
+    if id is not None:
+        return await _do_request("PUT", url, connection, data=raw.get_codec(connection).dumpb(record))
+    return await _do_request("POST", url, connection, data=raw.get_codec(connection).dumpb(record))
+
+async def bulk(connection, type, records, idkey='id'):
+    url = raw.elasticsearch_url(connection, type, endpoint="_bulk")
+    return await _do_request("POST", url, connection, data=b"".join(raw.bulk_lines(records, idkey=idkey, codec=raw.get_codec(connection))))
+
+############################################################
+## Delete records
+
+async def delete(connection, type=None, id=None):
+    url = raw.elasticsearch_url(connection, type, endpoint=id)
+    return await _do_request("DELETE", url, connection)
+
+##############################################################
+## Refresh
+
+async def refresh(connection):
+    url = raw.elasticsearch_url(connection, endpoint="_refresh")
+    return await _do_request("POST", url, connection)
@@ -0,0 +1,78 @@
+# In-process caches for records and query results, with LRU and TTL eviction
+
+import threading, time, json, hashlib
+from collections import OrderedDict
+from copy import deepcopy
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded cache which evicts the least recently used entry when it is full,
+    and treats entries older than ttl seconds (if given) as missing.  Values are copied on the way
+    in and out, so callers can modify what they get back without changing the cache.
+
+    Any object with the same get/set/delete/clear/stats methods can be used in its place, for
+    example to put the cache in memcached or redis.
+    """
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored = entry
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self.evictions += 1
+                self.misses += 1
+                return None
+            # put it back at the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+        return deepcopy(value)
+
+    def set(self, key, value):
+        value = deepcopy(value)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "size" : len(self._entries)
+            }
+
+def query_key(query, types=None, conn=None):
+    """
+    A key for a query which is the same for any two queries that would be sent as the same
+    request, however their dicts were built
+    """
+    parts = {"query" : query, "types" : types}
+    if conn is not None:
+        parts["host"] = conn.host
+        parts["port"] = str(conn.port)
+        parts["index"] = conn.index
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
@@ -1,30 +1,56 @@
 from esprit import tasks
 from esprit import raw
+from esprit import export as export_module
 
-def copy(source, source_type, target, target_type, limit=None, batch=1000):
+def copy(source, source_type, target, target_type, limit=None, batch=1000, workers=None, queue_size=None, processes=False, slices=None, compression=None):
     source_index = source.split("/")[-1]
     source_url = "/".join(source.split("/")[:-1])
-    sconn = raw.Connection(source_url, source_index)
 
     target_index = target.split("/")[-1]
     target_url = "/".join(target.split("/")[:-1])
-    tconn = raw.Connection(target_url, target_index)
 
-    tasks.copy(sconn, source_type, tconn, target_type, limit, batch)
+    with raw.Connection(source_url, source_index, compression=compression) as sconn, \
+            raw.Connection(target_url, target_index, compression=compression) as tconn:
+        return tasks.copy(sconn, source_type, tconn, target_type, limit, batch,
+                          workers=workers, queue_size=queue_size, processes=processes, slices=slices)
+
+def export(source, source_type, path, format=export_module.FORMAT_NDJSON, limit=None, batch=1000, slices=None, workers=None,
+           max_bytes=None, max_records=None, gzip=False, fields=None, compression=None):
+    source_index = source.split("/")[-1]
+    source_url = "/".join(source.split("/")[:-1])
+
+    with raw.Connection(source_url, source_index, compression=compression) as sconn:
+        return export_module.export(sconn, source_type, path, format, page_size=batch, limit=limit, slices=slices,
+                                    workers=workers, max_bytes=max_bytes, max_records=max_records, compress=gzip,
+                                    fields=fields)
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-c", "--copy", action="store_true", help="carry out a copy action")
+    parser.add_argument("-e", "--export", action="store_true", help="carry out an export action, of the source to files")
 
     # arguments used with copy
     parser.add_argument("-s", "--source", help="url of source index")
     parser.add_argument("-o", "--target", help="url of target index")
     parser.add_argument("-f", "--sourcetype", help="data type to copy from")
     parser.add_argument("-t", "--targettype", help="data type to copy to")
-    parser.add_argument("-l", "--limit", help="maximum number of records to copy")
-    parser.add_argument("-b", "--batch", help="batch size in copy operation")
+    parser.add_argument("-l", "--limit", type=int, help="maximum number of records to copy")
+    parser.add_argument("-b", "--batch", type=int, help="batch size in copy operation")
+    parser.add_argument("-w", "--workers", type=int, help="number of concurrent bulk writers; if omitted, read and write in turn")
+    parser.add_argument("-q", "--queue", type=int, help="maximum number of batches waiting to be written")
+    parser.add_argument("-p", "--processes", action="store_true", help="run the bulk writers as processes rather than threads")
+    parser.add_argument("-z", "--compress", choices=raw.COMPRESSIONS, help="compress request bodies with this encoding")
+    parser.add_argument("-n", "--slices", type=int, help="read the source with this many parallel scroll slices (ES 5.x and later)")
+
+    # arguments used with export (along with source, sourcetype, limit, batch, workers and slices)
+    parser.add_argument("-x", "--file", help="path to export to; may say where the slice and part numbers go with {slice} and {part}")
+    parser.add_argument("-F", "--format", choices=export_module.FORMATS, default=export_module.FORMAT_NDJSON, help="export file format")
+    parser.add_argument("-g", "--gzip", action="store_true", help="gzip the exported files")
+    parser.add_argument("-m", "--max-bytes", type=int, help="split the export into files of about this many bytes (before gzip)")
+    parser.add_argument("-r", "--max-records", type=int, help="split the export into files of this many records")
+    parser.add_argument("-k", "--fields", help="comma separated fields (dotted paths) for the columns of a csv export")
 
     args = parser.parse_args()
 
@@ -35,5 +61,16 @@ if __name__ == "__main__":
         target_type = args.targettype
         limit = args.limit if args.limit else None
         batch = args.batch if args.batch else 1000
-        print("copying with", source, source_type, target, target_type, "limit", limit, "batch size", batch)
-        copy(source, source_type, target, target_type, limit, batch)
\ No newline at end of file
+        print("copying with", source, source_type, target, target_type, "limit", limit, "batch size", batch, "workers", args.workers)
+        stats = copy(source, source_type, target, target_type, limit, batch,
+                     workers=args.workers, queue_size=args.queue, processes=args.processes, slices=args.slices, compression=args.compress)
+        print(str(stats))
+
+    if args.export:
+        batch = args.batch if args.batch else 1000
+        fields = args.fields.split(",") if args.fields else None
+        print("exporting", args.source, args.sourcetype, "to", args.file, "as", args.format, "limit", args.limit, "slices", args.slices)
+        stats = export(args.source, args.sourcetype, args.file, args.format, args.limit, batch, slices=args.slices,
+                       workers=args.workers, max_bytes=args.max_bytes, max_records=args.max_records, gzip=args.gzip,
+                       fields=fields, compression=args.compress)
+        print(str(stats))
@@ -0,0 +1,107 @@
+# JSON encoding and decoding for request and response bodies.  The standard library json module
+# is used unless a faster one is chosen, either for a single Connection (its codec argument) or
+# for everything (set_default)
+
+import json
+
+class JSONCodec(object):
+    """
+    The standard library json module.  The other codecs have the same interface: dumps gives
+    text, dumpb gives the utf-8 bytes to send, and loads takes either
+    """
+    name = "json"
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def dumpb(self, obj):
+        s = json.dumps(obj)
+        return s if isinstance(s, bytes) else s.encode("utf-8")
+
+    def loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode("utf-8")
+        return json.loads(s)
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def dumpb(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, s):
+        return orjson.loads(s)
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+    def dumpb(self, obj):
+        s = self.dumps(obj)
+        return s if isinstance(s, bytes) else s.encode("utf-8")
+
+    def loads(self, s):
+        return ujson.loads(s)
+
+class SimplejsonCodec(JSONCodec):
+    name = "simplejson"
+
+    def dumps(self, obj):
+        return simplejson.dumps(obj)
+
+    def dumpb(self, obj):
+        s = simplejson.dumps(obj)
+        return s if isinstance(s, bytes) else s.encode("utf-8")
+
+    def loads(self, s):
+        return simplejson.loads(s)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+# fastest first
+_available = [c for c, module in [(OrjsonCodec, orjson), (UjsonCodec, ujson), (SimplejsonCodec, simplejson)] if module is not None]
+_available.append(JSONCodec)
+
+def available():
+    return [c.name for c in _available]
+
+def get(name):
+    """
+    Get a codec by name, or "auto" for the fastest one installed
+    """
+    if name == "auto":
+        return _available[0]()
+    for c in _available:
+        if c.name == name:
+            return c()
+    raise ValueError("json codec '" + str(name) + "' is not installed; available are " + ", ".join(available()))
+
+_default = JSONCodec()
+
+def default():
+    return _default
+
+def set_default(codec):
+    """
+    Use the given codec (or codec name) wherever a Connection doesn't have its own
+    """
+    global _default
+    _default = get(codec) if not isinstance(codec, JSONCodec) else codec
@@ -1,7 +1,11 @@
-import uuid, json
+import uuid
 from esprit import raw, util, tasks
+from esprit.models import QueryCompiler
+from esprit import cache as cache_module
 from copy import deepcopy
-import time
+
+# builds the bodies for DomainObject.query and dataformat_query
+query_compiler = QueryCompiler()
 
 class StoreException(Exception):
     def __init__(self, value):
@@ -10,44 +14,107 @@ class StoreException(Exception):
         return repr(self.value)
 
 class DAO(object):
-    
+    __slots__ = []
+
     @classmethod
     def makeid(cls):
         return uuid.uuid4().hex
     
     def actions(self, conn, action_queue):
+        # stores and removes by id are sent through one bulk indexer.  Removes by query can't go
+        # in a bulk request, so the indexer is flushed first to keep the actions in order
+        indexer = raw.BulkIndexer(conn, idkey=None)
         for action in action_queue:
-            if action.keys()[0] == "remove":
-                self._action_remove(conn, action)
-            elif action.keys()[0] == "store":
-                self._action_store(conn, action)
+            if list(action.keys())[0] == "remove":
+                self._action_remove(conn, action, indexer)
+            elif list(action.keys())[0] == "store":
+                self._action_store(conn, action, indexer)
+        return indexer.close()
     
-    def _action_remove(self, conn, remove_action):
+    def _action_remove(self, conn, remove_action, indexer=None):
         obj = remove_action.get("remove")
         if "index" not in obj:
             raise StoreException("no index provided for remove action")
         if "id" not in obj and "query" not in obj:
             raise StoreException("no id or query provided for remove action")
         if "id" in obj:
-            raw.delete(conn, obj.get("index"), obj.get("id"))
+            if indexer is not None:
+                indexer.add(action="delete", id=obj.get("id"), type=obj.get("index"))
+            else:
+                raw.delete(conn, obj.get("index"), obj.get("id"))
         elif "query" in obj:
+            if indexer is not None:
+                indexer.flush()
             raw.delete_by_query(conn, obj.get("index"), obj.get("query"))
 
-    def _action_store(self, conn, store_action):
+    def _action_store(self, conn, store_action, indexer=None):
         obj = store_action.get("store")
         if "index" not in obj:
             raise StoreException("no index provided for store action")
         if "record" not in obj:
             raise StoreException("no record provided for store action")
-        raw.store(conn, obj.get("index"), obj.get("record"), obj.get("id"))
+        if indexer is not None:
+            indexer.add(obj.get("record"), action="index", id=obj.get("id"), type=obj.get("index"))
+        else:
+            raw.store(conn, obj.get("index"), obj.get("record"), obj.get("id"))
     
 class DomainObject(DAO):
+    # the record is all an instance holds, so there is no per-instance __dict__.  A subclass which
+    # doesn't declare __slots__ of its own gets one back, and can set what attributes it likes
+    __slots__ = ["data"]
+
     __type__ = None
     __conn__ = None
+
+    # set to a cache.LRUCache (or anything with the same interface) to have pull and pull_many
+    # read through it.  Entries are dropped when this class saves or deletes the record
+    __cache__ = None
+
+    # likewise, set to a cache to keep the results of query (and so count and object_query),
+    # keyed on the final query.  It is cleared whenever this class writes
+    __query_cache__ = None
+
+    # use millisecond precision for created_date and last_updated
+    __subsecond_timestamps__ = False
     
     def __init__(self, raw=None):
         self.data = raw if raw is not None else {}
 
+    def __getstate__(self):
+        state = dict(getattr(self, "__dict__", {}))
+        state["data"] = self.data
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    @classmethod
+    def wrap_many(cls, records, wrap=True, hits=False):
+        '''Wrap a batch of records as objects of this class (or unpack them only, if wrap is
+        False), in a list.  With hits, the records are search hits, whose _source is taken.'''
+        wrapper = cls._wrapper(wrap, hits)
+        return [wrapper(r) for r in records]
+
+    @classmethod
+    def _wrapper(cls, wrap, hits=False):
+        # a function which wraps one record the way wrap says
+        if not wrap:
+            return raw.unpack_hit if hits else lambda r: r
+        if not _plain_init(cls):
+            return (lambda r: cls(raw.unpack_hit(r))) if hits else cls
+
+        # __init__ would only set data, so leave it out
+        new = object.__new__
+        unpack = raw.unpack_hit if hits else None
+        def wrapper(r):
+            if unpack is not None:
+                r = unpack(r)
+            o = new(cls)
+            o.data = r if r is not None else {}
+            return o
+        return wrapper
+
     @classmethod
     def dynamic_read_types(cls):
         return None
@@ -104,7 +171,7 @@ class DomainObject(DAO):
 
     @property
     def json(self):
-        return json.dumps(self.data)
+        return raw.get_codec(self.__conn__).dumps(self.data)
     
     @property
     def raw(self):
@@ -117,31 +184,111 @@ class DomainObject(DAO):
         raw.refresh(conn)
     
     @classmethod
-    def pull(cls, id_, conn=None, wrap=True, types=None):
+    def pull(cls, id_, conn=None, wrap=True, types=None, use_cache=True):
         '''Retrieve object by id.'''
         if conn is None:
             conn = cls.__conn__
 
+        # the cache only holds records pulled from the default read types
+        cache = cls.__cache__ if use_cache and types is None else None
         types = cls.get_read_types(types)
 
         if id_ is None:
             return None
         try:
-            for t in types:
-                resp = raw.get(conn, t, id_)
-                if resp.status_code == 404:
-                    continue
-                else:
-                    j = raw.unpack_get(resp)
-                    if wrap:
-                        return cls(j)
+            j = cache.get(cls._cache_key(conn, id_)) if cache is not None else None
+            if j is None:
+                for t in types:
+                    resp = raw.get(conn, t, id_)
+                    if resp.status_code == 404:
+                        continue
                     else:
-                        return j
-            return None
+                        j = raw.unpack_get(resp)
+                        if cache is not None:
+                            cache.set(cls._cache_key(conn, id_), j)
+                        break
+            if j is None:
+                return None
+            if wrap:
+                return cls(j)
+            else:
+                return j
         except Exception as e:
-            print(e.message)
+            print(str(e))
             return None
-    
+
+    @classmethod
+    def _cache_key(cls, conn, id_):
+        # ids are only unique within a type, and subclasses may share a cache, so the key holds the
+        # read types the record was pulled from
+        return (conn.host, str(conn.port), str(conn.index), tuple(cls.get_read_types()), id_)
+
+    @classmethod
+    def _uncache(cls, conn, id_):
+        if cls.__cache__ is not None and id_ is not None:
+            cls.__cache__.delete(cls._cache_key(conn, id_))
+        # any write may change any query's results
+        if cls.__query_cache__ is not None:
+            cls.__query_cache__.clear()
+
+    @classmethod
+    def pull_many(cls, ids, conn=None, wrap=True, types=None, chunk_size=500, dedupe=True, use_cache=True):
+        '''Retrieve objects by id with as few mget requests as possible.
+
+        Returns a list in the same order as ids, with None for any id which wasn't found.  With
+        dedupe, each distinct id is only asked for once.'''
+        if conn is None:
+            conn = cls.__conn__
+
+        cache = cls.__cache__ if use_cache and types is None else None
+        types = cls.get_read_types(types)
+
+        ids = list(ids)
+        found = {}
+        wanted = []
+        seen = set()
+        for id_ in ids:
+            if id_ is None or (dedupe and id_ in seen):
+                continue
+            seen.add(id_)
+            cached = cache.get(cls._cache_key(conn, id_)) if cache is not None else None
+            if cached is not None:
+                found[id_] = cached
+            else:
+                wanted.append(id_)
+
+        for i in range(0, len(wanted), chunk_size):
+            chunk = wanted[i:i + chunk_size]
+            resp = raw.mget(conn, types, chunk)
+            if resp.status_code == 404:
+                # the index isn't there, so none of them are
+                continue
+            if resp.status_code != 200:
+                raise raw.ESWireException("mget failed with status " + str(resp.status_code) + ": " + resp.text)
+            docs = raw.unpack_mget(resp)
+            # the docs come back id-major, one for each read type, so take the first type that had it
+            for j, id_ in enumerate(chunk):
+                for d in docs[j * len(types):(j + 1) * len(types)]:
+                    if d is not None:
+                        found[id_] = d
+                        if cache is not None:
+                            cache.set(cls._cache_key(conn, id_), d)
+                        break
+
+        results = []
+        given = set()
+        for id_ in ids:
+            d = found.get(id_)
+            if d is not None:
+                # a repeated id gets its own copy, so that changing one result doesn't change another
+                if id_ in given:
+                    d = deepcopy(d)
+                given.add(id_)
+                if wrap:
+                    d = cls(d)
+            results.append(d)
+        return results
+
     # 2016-11-09 TD : introduction of different output formats, e.g. csv
     #                 See http://github.com/codelibs/elasticsearch-dataformats for details!
     @classmethod
@@ -158,81 +305,39 @@ class DomainObject(DAO):
             conn = cls.__conn__
 
         types = cls.get_read_types(types)
-        
-        if isinstance(q,dict):
-            query = q
-            if 'bool' not in query['query']:
-                boolean = {'bool':{'must': [] }}
-                boolean['bool']['must'].append( query['query'] )
-                query['query'] = boolean
-            if 'must' not in query['query']['bool']:
-                query['query']['bool']['must'] = []
-        elif q:
-            query = {
-                'query': {
-                    'bool': {
-                        'must': [
-                            {'query_string': { 'query': q }}
-                        ]
-                    }
-                }
-            }
-        else:
-            query = {
-                'query': {
-                    'bool': {
-                        'must': [
-                            {'match_all': {}}
-                        ]
-                    }
-                }
-            }
-
-        if facets:
-            if 'facets' not in query:
-                query['facets'] = {}
-            for k, v in facets.items():
-                query['facets'][k] = {"terms":v}
-
-        if terms:
-            boolean = {'must': [] }
-            for term in terms:
-                if not isinstance(terms[term],list): terms[term] = [terms[term]]
-                for val in terms[term]:
-                    obj = {'term': {}}
-                    obj['term'][ term ] = val
-                    boolean['must'].append(obj)
-            if q and not isinstance(q,dict):
-                boolean['must'].append( {'query_string': { 'query': q } } )
-            elif q and 'query' in q:
-                boolean['must'].append( query['query'] )
-            query['query'] = {'bool': boolean}
 
         # 2016-11-09 TD : set for dataformat output
-        fmt = "csv"
-
-        for k,v in kwargs.items():
-            # 2016-11-09 TD : enable dataformat output via kwargs
-            if k == '_dataformat':
-                fmt = v
-            elif k == '_from':
-            #if k == '_from':
-                query['from'] = v
-            else:
-                query[k] = v
-
-        if should_terms is not None and len(should_terms) > 0:
-            for s in should_terms:
-                if not isinstance(should_terms[s],list): should_terms[s] = [should_terms[s]]
-                query["query"]["bool"]["must"].append({"terms" : {s : should_terms[s]}})
+        fmt = kwargs.pop("_dataformat", "csv")
+        template, params = query_compiler.compile(q, terms=terms, should_terms=should_terms, facets=facets, **kwargs)
 
         # 2016-11-09 TD : call dataformat output
         #                 Note that !!no!! json() is returned
-        return raw.data(conn, types, query, fmt=fmt, url_params=url_params)
+        return raw.data(conn, types, fmt=fmt, url_params=url_params, body=template.dumpb(raw.get_codec(conn), params))
+
+    @classmethod
+    def dataformat_download(cls, out, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, url_params=None,
+                            chunk_size=None, offset=0, progress=None, **kwargs):
+        '''Perform a dataformat query, writing the output to out as it arrives rather than returning it.
+
+        :param out: a path, a file opened for writing bytes, or a function to call with each chunk.
+        :param chunk_size: bytes to write at a time, raw.DOWNLOAD_CHUNK_SIZE by default.
+        :param offset: resume a download which has already got this many bytes.
+        :param progress: function to call with the raw.DownloadProgress after each chunk.
+        The rest are as for dataformat_query.  Returns the raw.DownloadProgress
+        '''
+        if conn is None:
+            conn = cls.__conn__
+
+        types = cls.get_read_types(types)
+        fmt = kwargs.pop("_dataformat", "csv")
+        template, params = query_compiler.compile(q, terms=terms, should_terms=should_terms, facets=facets, **kwargs)
+        return raw.data_download(conn, out, types, fmt=fmt, url_params=url_params, body=template.dumpb(raw.get_codec(conn), params),
+                                 chunk_size=chunk_size if chunk_size is not None else raw.DOWNLOAD_CHUNK_SIZE,
+                                 offset=offset, progress=progress)
 
 
     @classmethod
-    def query(cls, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, **kwargs):
+    def query(cls, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, use_cache=True, **kwargs):
         '''Perform a query on backend.
 
         :param q: maps to query_string parameter if string, or query dict if dict.
@@ -245,93 +350,52 @@ class DomainObject(DAO):
             conn = cls.__conn__
 
         types = cls.get_read_types(types)
-        
-        if isinstance(q,dict):
-            query = q
-            if 'bool' not in query['query']:
-                boolean = {'bool':{'must': [] }}
-                boolean['bool']['must'].append( query['query'] )
-                query['query'] = boolean
-            if 'must' not in query['query']['bool']:
-                query['query']['bool']['must'] = []
-        elif q:
-            query = {
-                'query': {
-                    'bool': {
-                        'must': [
-                            {'query_string': { 'query': q }}
-                        ]
-                    }
-                }
-            }
-        else:
-            query = {
-                'query': {
-                    'bool': {
-                        'must': [
-                            {'match_all': {}}
-                        ]
-                    }
-                }
-            }
-
-        if facets:
-            if 'facets' not in query:
-                query['facets'] = {}
-            for k, v in facets.items():
-                query['facets'][k] = {"terms":v}
-
-        if terms:
-            boolean = {'must': [] }
-            for term in terms:
-                if not isinstance(terms[term],list): terms[term] = [terms[term]]
-                for val in terms[term]:
-                    obj = {'term': {}}
-                    obj['term'][ term ] = val
-                    boolean['must'].append(obj)
-            if q and not isinstance(q,dict):
-                boolean['must'].append( {'query_string': { 'query': q } } )
-            elif q and 'query' in q:
-                boolean['must'].append( query['query'] )
-            query['query'] = {'bool': boolean}
-
-        for k,v in kwargs.items():
-            if k == '_from':
-                query['from'] = v
-            else:
-                query[k] = v
+        template, params = query_compiler.compile(q, terms=terms, should_terms=should_terms, facets=facets, **kwargs)
 
-        if should_terms is not None and len(should_terms) > 0:
-            for s in should_terms:
-                if not isinstance(should_terms[s],list): should_terms[s] = [should_terms[s]]
-                query["query"]["bool"]["must"].append({"terms" : {s : should_terms[s]}})
+        cache = cls.__query_cache__ if use_cache else None
+        if cache is not None:
+            key = cache_module.query_key(template.fill(params), types, conn)
+            j = cache.get(key)
+            if j is not None:
+                return j
 
-        r = raw.search(conn, types, query)
-        return r.json()
+        r = raw.search(conn, types, body=template.dumpb(raw.get_codec(conn), params))
+        j = raw.decode(r)
+        if cache is not None and r.status_code == 200:
+            cache.set(key, j)
+        return j
 
     @classmethod
-    def object_query(cls, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, **kwargs):
-        j = cls.query(q=q, terms=terms, should_terms=should_terms, facets=facets, conn=conn, types=types, **kwargs)
+    def object_query(cls, q='', terms=None, should_terms=None, facets=None, conn=None, types=None, use_cache=True, **kwargs):
+        j = cls.query(q=q, terms=terms, should_terms=should_terms, facets=facets, conn=conn, types=types, use_cache=use_cache, **kwargs)
         res = raw.unpack_json_result(j)
-        return [cls(r) for r in res]
+        return cls.wrap_many(res)
+
+    def save(self, conn=None, makeid=True, created=True, updated=True, blocking=False, type=None, refresh=None):
+        '''Store the object.
 
-    def save(self, conn=None, makeid=True, created=True, updated=True, blocking=False, type=None):
+        With blocking, the store request itself waits until the record is visible to search, by
+        asking for the given refresh: raw.REFRESH_WAIT_FOR (ES 5.x and later) waits for the next
+        scheduled refresh, raw.REFRESH_TRUE (any version) forces one straight away.  By default it
+        is whichever the cluster has (see raw.default_refresh).'''
         if conn is None:
             conn = self.__conn__
+        if blocking and refresh is None:
+            refresh = raw.default_refresh(conn)
 
         type = self.get_write_type(type)
 
-        if blocking and not updated:
-            raise StoreException("Unable to do blocking save on record where last_updated is not set")
+        self._prepare_save(util.now(subsecond=self.__subsecond_timestamps__), makeid, created, updated)
 
-        now = util.now()
-        if blocking:
-            # we need the new last_updated time to be later than the new one
-            if now == self.last_updated:
-                time.sleep(1)   # timestamp granularity is seconds, so just sleep for 1
-            now = util.now()    # update the new timestamp
+        params = {"refresh" : refresh} if blocking else None
+        resp = raw.store(conn, type, self.data, self.id, params=params)
+        self._uncache(conn, self.id)
 
-        # the main body of the save
+        if blocking and resp.status_code >= 300:
+            raise StoreException("Blocking save of record {x} failed: {y}".format(x=self.id, y=resp.text))
+        return resp
+
+    def _prepare_save(self, now, makeid=True, created=True, updated=True):
         if makeid:
             if "id" not in self.data:
                 self.id = self.makeid()
@@ -341,33 +405,58 @@ class DomainObject(DAO):
         if updated:
             self.data['last_updated'] = now
 
-        raw.store(conn, type, self.data, self.id)
-
-        if blocking:
-            q = {
-                "query" : {
-                    "term" : {"id.exact" : self.id}
-                },
-                "fields" : ["last_updated"]
-            }
-            while True:
-                res = raw.search(conn, type, q)
-                j = raw.unpack_result(res)
-                if len(j) == 0:
-                    time.sleep(0.5)
-                    continue
-                if len(j) > 1:
-                    raise StoreException("More than one record with id {x}".format(x=self.id))
-                if j[0].get("last_updated")[0] == now:  # NOTE: only works on ES > 1.x
-                    break
-                else:
-                    time.sleep(0.5)
-                    continue
-        
+    @classmethod
+    def save_all(cls, objs, conn=None, makeid=True, created=True, updated=True, blocking=False, type=None, chunk_size=1000):
+        '''Store many objects with chunked bulk requests.
+
+        The objects get the same id and timestamp defaults as save.  Returns the bulk result for
+        each object, in order.  With blocking, the last chunk waits for the next refresh where the
+        cluster allows it (see raw.BulkIndexer), and the index is refreshed once otherwise.'''
+        if conn is None:
+            conn = cls.__conn__
+
+        type = cls.get_write_type(type)
+        now = util.now(subsecond=cls.__subsecond_timestamps__)
+
+        indexer = raw.BulkIndexer(conn, type, max_docs=chunk_size, refresh=blocking)
+        for o in objs:
+            o._prepare_save(now, makeid, created, updated)
+            indexer.add(o.data, id=o.id)
+            cls._uncache(conn, o.id)
+        return indexer.close().items
+
+    @classmethod
+    def delete_all(cls, objs_or_ids, conn=None, type=None, chunk_size=1000):
+        '''Delete many objects (or ids) with chunked bulk requests.
+
+        Returns a result for each object, in order.  If there is more than one read type, the delete
+        is sent to every type, and it succeeded if it succeeded in any of them.'''
+        if conn is None:
+            conn = cls.__conn__
+
+        types = cls.get_read_types(type)
+
+        ids = [o.id if isinstance(o, DomainObject) else o for o in objs_or_ids]
+        indexer = raw.BulkIndexer(conn, max_docs=chunk_size)
+        for id_ in ids:
+            for t in types:
+                indexer.add(action="delete", id=id_, type=t)
+            cls._uncache(conn, id_)
+        items = indexer.close().items
+
+        results = []
+        for i, id_ in enumerate(ids):
+            attempts = items[i * len(types):(i + 1) * len(types)]
+            done = [a for a in attempts if a.get("ok")]
+            results.append(done[0] if len(done) > 0 else attempts[-1])
+        return results
+
     def delete(self, conn=None, type=None):
         if conn is None:
             conn = self.__conn__
 
+        self._uncache(conn, self.id)
+
         # the record may be in any one of the read types, so we need to check them all
         types = self.get_read_types(type)
 
@@ -382,41 +471,45 @@ class DomainObject(DAO):
                 raw.delete(conn, t, self.id)
 
     @classmethod
-    def delete_by_query(cls, query, conn=None, es_version="0.90.13", type=None):
+    def delete_by_query(cls, query, conn=None, es_version=None, type=None):
         if conn is None:
             conn = cls.__conn__
         type = cls.get_write_type(type)
 
         raw.delete_by_query(conn, type, query, es_version=es_version)
 
+        # there's no telling which records went, so drop them all
+        if cls.__cache__ is not None:
+            cls.__cache__.clear()
+        if cls.__query_cache__ is not None:
+            cls.__query_cache__.clear()
+
     @classmethod
-    def iterate(cls, q, page_size=1000, limit=None, wrap=True, **kwargs):
-        q = q.copy()
-        q["size"] = page_size
-        q["from"] = 0
-        if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
-            q["sort"] = [{"id" : {"order" : "asc"}}]
+    def iterate(cls, q, page_size=1000, limit=None, wrap=True, paging=None, prefetch=None, **kwargs):
+        if paging is None:
+            paging = tasks.default_paging(kwargs.get("conn") or cls.__conn__)
+        # each page is read once, so there's no point filling the query cache with them
+        kwargs["use_cache"] = False
+        def search(query):
+            return cls.query(q=query, **kwargs)
+        pages = tasks.iterate_pages(search, q, page_size=page_size, paging=paging)
+        if prefetch:
+            pages = tasks.prefetch_pages(pages, prefetch, limit)
+        wrapper = cls._wrapper(wrap, hits=True)
         counter = 0
-        while True:
-            # apply the limit
-            if limit is not None and counter >= limit:
-                break
-
-            res = cls.query(q=q, **kwargs)
-            rs = [r.get("_source") if "_source" in r else r.get("fields") for r in res.get("hits", {}).get("hits", [])]
-            # print counter, len(rs), res.get("hits", {}).get("total"), len(res.get("hits", {}).get("hits", [])), json.dumps(q)
-            if len(rs) == 0:
-                break
-            for r in rs:
+        try:
+            for hits in pages:
+                for h in hits:
+                    # apply the limit
+                    if limit is not None and counter >= limit:
+                        return
+                    counter += 1
+                    yield wrapper(h)
                 # apply the limit (again)
                 if limit is not None and counter >= limit:
-                    break
-                counter += 1
-                if wrap:
-                    yield cls(r)
-                else:
-                    yield r
-            q["from"] += page_size
+                    return
+        finally:
+            pages.close()
 
     @classmethod
     def iterall(cls, page_size=1000, limit=None, **kwargs):
@@ -430,7 +523,8 @@ class DomainObject(DAO):
         return res.get("hits", {}).get("total")
 
     @classmethod
-    def scroll(cls, q=None, page_size=1000, limit=None, keepalive="10m", conn=None, raise_on_scroll_error=True, types=None):
+    def scroll(cls, q=None, page_size=1000, limit=None, keepalive="10m", conn=None, raise_on_scroll_error=True, types=None,
+               slices=None, workers=None, ordered=False, stream=False, prefetch=None, wrap=True):
     # 2018-12-19 TD : raise keepalive value to '10m'
     #
     # def scroll(cls, q=None, page_size=1000, limit=None, keepalive="1m", conn=None, raise_on_scroll_error=True, types=None):
@@ -442,17 +536,28 @@ class DomainObject(DAO):
         if q is None:
             q = {"query" : {"match_all" : {}}}
 
-        gen = tasks.scroll(conn, types, q, page_size=page_size, limit=limit, keepalive=keepalive)
+        gen = tasks.scroll(conn, types, q, page_size=page_size, limit=limit, keepalive=keepalive,
+                           slices=slices, workers=workers, ordered=ordered, stream=stream, prefetch=prefetch)
 
+        wrapper = cls._wrapper(wrap)
         try:
             for o in gen:
-                yield cls(o)
+                yield wrapper(o)
         except tasks.ScrollException as e:
             if raise_on_scroll_error:
                 raise e
             else:
                 return
+        finally:
+            gen.close()
     
+def _plain_init(cls):
+    # whether cls is made with DomainObject's own __init__
+    for c in cls.__mro__:
+        if "__init__" in c.__dict__:
+            return c is DomainObject
+    return False
+
 ########################################################################
 ## Some useful ES queries
 ########################################################################
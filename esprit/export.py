@@ -0,0 +1,400 @@
+# Exporting a type to files as NDJSON, a JSON array or CSV.  Records are read with a scroll (sliced,
+# if asked, with each slice read and written by its own thread to its own files), encoded with the
+# connection's codec, and written through large buffers, optionally gzipped and split into parts
+# of a maximum size
+
+import io, os, gzip, time, threading
+from esprit import raw, tasks
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_JSON = "json"
+FORMAT_CSV = "csv"
+FORMATS = [FORMAT_NDJSON, FORMAT_JSON, FORMAT_CSV]
+
+BUFFER_SIZE = 1024 * 1024
+
+_text = type(u"")
+
+class ExportException(Exception):
+    pass
+
+class ExportStats(object):
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0          # as encoded, before any compression
+        self.written = 0        # on disk
+        self.files = []
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, writer):
+        self.records += writer.records
+        self.bytes += writer.bytes
+        for path in writer.files:
+            self.files.append(path)
+            self.written += os.path.getsize(path)
+
+    def finish(self):
+        self.finished = time.time()
+        self.files.sort()
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.records / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def byte_rate(self):
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "exported {r} records to {f} files, {b} bytes ({w} on disk) in {s:.1f}s ({p:.1f} records/s, {m:.2f} MB/s)".format(
+            r=self.records, f=len(self.files), b=self.bytes, w=self.written, s=self.elapsed, p=self.rate,
+            m=self.byte_rate / 1048576.0)
+
+##################################################################
+## Writers
+
+def open_output(path, compress=False, compress_level=6):
+    """
+    Open path for writing bytes, gzipped if compress is True.  The writers do their own buffering,
+    so what they write here comes in large pieces
+    """
+    if compress:
+        return gzip.GzipFile(path, "wb", compress_level)
+    return io.open(path, "wb")
+
+class RecordWriter(object):
+    """
+    Encodes records and writes them to a binary file, holding them until buffer_size bytes have
+    built up so that the file (and gzip, if it is compressed) sees a few large writes rather than
+    one per record.  Records are written one per line, as json (NDJSON), unless a subclass encodes
+    them otherwise.  records and bytes count what has been written, before compression
+    """
+    header = b""
+    separator = b""
+    footer = b""
+
+    def __init__(self, f, codec, buffer_size=BUFFER_SIZE):
+        self.f = f
+        self.codec = codec
+        self.buffer_size = buffer_size
+        self.records = 0
+        self.bytes = 0
+        self._chunks = []
+        self._buffered = 0
+
+    def encode(self, record):
+        return self.codec.dumpb(record) + b"\n"
+
+    def write(self, record):
+        if self.records == 0:
+            self._append(self.begin(record))
+        elif self.separator:
+            self._append(self.separator)
+        self._append(self.encode(record))
+        self.records += 1
+
+    def begin(self, record):
+        return self.header
+
+    def flush(self):
+        if len(self._chunks) > 0:
+            self.f.write(b"".join(self._chunks))
+            self._chunks = []
+            self._buffered = 0
+
+    def close(self):
+        if self.records == 0:
+            self._append(self.begin(None))
+        self._append(self.footer)
+        self.flush()
+        self.f.close()
+
+    def _append(self, data):
+        if not data:
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        self.bytes += len(data)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+class NDJSONWriter(RecordWriter):
+    pass
+
+class JSONArrayWriter(RecordWriter):
+    header = b"["
+    separator = b",\n"
+    footer = b"]\n"
+
+    def encode(self, record):
+        return self.codec.dumpb(record)
+
+class CSVWriter(RecordWriter):
+    """
+    Writes one row per record, with a header row of the field names.  fields may be dotted paths
+    into nested objects; if they aren't given, the top level keys of the first record are used, in
+    sorted order.  fields may also be a Columns shared with other writers, so that they all get the
+    same ones.  Strings are written as they are, other values as json, and missing values as empty
+    cells
+    """
+    def __init__(self, f, codec, buffer_size=BUFFER_SIZE, fields=None):
+        super(CSVWriter, self).__init__(f, codec, buffer_size)
+        self.fields = fields
+        self._paths = None
+
+    def begin(self, record):
+        if isinstance(self.fields, Columns):
+            self.fields = self.fields.resolve(record)
+        elif self.fields is None:
+            self.fields = sorted(record.keys()) if record is not None else []
+        self._paths = [field.split(".") for field in self.fields]
+        return self._row(self.fields) if len(self.fields) > 0 else b""
+
+    def encode(self, record):
+        return self._row([self._cell(_lookup(record, path)) for path in self._paths])
+
+    def _cell(self, value):
+        if value is None:
+            return u""
+        if isinstance(value, bytes):
+            return value.decode("utf-8")
+        if isinstance(value, _text):
+            return value
+        return self.codec.dumps(value)
+
+    def _row(self, cells):
+        return (u",".join([_csv_quote(c) for c in cells]) + u"\r\n").encode("utf-8")
+
+class Columns(object):
+    """
+    The columns of a csv export written by several writers at once (one per slice): the fields,
+    if they are given, otherwise the top level keys of the first record any of them writes
+    """
+    def __init__(self, fields=None):
+        self.fields = fields
+        self._lock = threading.Lock()
+
+    def resolve(self, record):
+        with self._lock:
+            if self.fields is None and record is not None:
+                self.fields = sorted(record.keys())
+            return self.fields if self.fields is not None else []
+
+def _lookup(record, path):
+    value = record
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def _csv_quote(cell):
+    if u"," in cell or u'"' in cell or u"\n" in cell or u"\r" in cell:
+        return u'"' + cell.replace(u'"', u'""') + u'"'
+    return cell
+
+WRITERS = {
+    FORMAT_NDJSON : NDJSONWriter,
+    FORMAT_JSON : JSONArrayWriter,
+    FORMAT_CSV : CSVWriter
+}
+
+EXTENSIONS = {
+    FORMAT_NDJSON : ".ndjson",
+    FORMAT_JSON : ".json",
+    FORMAT_CSV : ".csv"
+}
+
+def make_writer(format, f, codec, buffer_size=BUFFER_SIZE, fields=None):
+    if format not in WRITERS:
+        raise ExportException("unknown export format '" + str(format) + "'; use one of " + ", ".join(FORMATS))
+    if format == FORMAT_CSV:
+        return CSVWriter(f, codec, buffer_size, fields=fields)
+    return WRITERS[format](f, codec, buffer_size)
+
+def output_path(path, format, slice=None, part=None, compress=False):
+    """
+    The name of the file for the given slice and part.  path may say where they go with {slice}
+    and {part}; otherwise whichever are in use are added before the extension, so out.ndjson
+    becomes out-3-0.ndjson.  gzipped files get .gz on the end
+    """
+    gz = path.endswith(".gz")
+    if gz:
+        path = path[:-3]
+    if "{slice}" in path or "{part}" in path:
+        path = path.replace("{slice}", str(slice if slice is not None else 0))
+        path = path.replace("{part}", str(part if part is not None else 0))
+    else:
+        base, ext = os.path.splitext(path)
+        if ext == "":
+            ext = EXTENSIONS.get(format, "")
+        for n in [slice, part]:
+            if n is not None:
+                base += "-" + str(n)
+        path = base + ext
+    if compress or gz:
+        path += ".gz"
+    return path
+
+class SplitWriter(object):
+    """
+    Writes records in the given format to one file, or to numbered parts which are each closed
+    once they reach max_bytes (before compression) or max_records, if either is given
+    """
+    def __init__(self, path, format, codec, slice=None, max_bytes=None, max_records=None, compress=False,
+                 compress_level=6, buffer_size=BUFFER_SIZE, fields=None):
+        self.path = path
+        self.format = format
+        self.codec = codec
+        self.slice = slice
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.compress = compress
+        self.compress_level = compress_level
+        self.buffer_size = buffer_size
+        self.fields = fields
+        self.split = max_bytes is not None or max_records is not None
+        self.records = 0
+        self.bytes = 0
+        self.files = []
+        self._current = None
+        self._open()
+
+    def _open(self):
+        part = len(self.files) if self.split else None
+        path = output_path(self.path, self.format, self.slice, part, self.compress)
+        f = open_output(path, self.compress, self.compress_level)
+        self._current = make_writer(self.format, f, self.codec, self.buffer_size, self.fields)
+        self.files.append(path)
+
+    def _close_current(self):
+        w = self._current
+        self._current = None
+        w.close()
+        self.records += w.records
+        self.bytes += w.bytes
+        # every part of a csv export has the same columns as the first
+        if self.format == FORMAT_CSV:
+            self.fields = w.fields
+
+    def write(self, record):
+        if self._current is None:
+            self._open()
+        w = self._current
+        w.write(record)
+        if (self.max_bytes is not None and w.bytes >= self.max_bytes) or \
+                (self.max_records is not None and w.records >= self.max_records):
+            self._close_current()
+
+    def close(self):
+        if self._current is not None:
+            self._close_current()
+
+##################################################################
+## Exporting
+
+def export(conn, type, path, format=FORMAT_NDJSON, q=None, page_size=1000, limit=None, slices=None, workers=None,
+           max_bytes=None, max_records=None, compress=False, compress_level=6, fields=None, transform=None,
+           keepalive="10m", buffer_size=BUFFER_SIZE):
+    """
+    Export the records matching q (all of them by default) to path in the given format (one of
+    FORMATS), and return an ExportStats.
+
+    With slices (ES 5.x and later), the type is read with that many scroll slices, each written to
+    its own files by its own thread (up to workers at once, if given).  max_bytes and max_records
+    split each slice's output into parts.  See output_path for how the files are named; a path
+    ending .gz is always gzipped.  fields chooses the columns of a csv export (by default, the keys of
+    the first record written, in every file), and transform, if given, is applied to each record
+    before it is written
+    """
+    if format not in WRITERS:
+        raise ExportException("unknown export format '" + str(format) + "'; use one of " + ", ".join(FORMATS))
+    compress = compress or path.endswith(".gz")
+    codec = raw.get_codec(conn)
+    q = tasks._scroll_query(q, page_size)
+    stats = ExportStats()
+
+    sliced = slices is not None and slices > 1
+    if sliced and format == FORMAT_CSV:
+        # every slice's files get the same columns, whichever slice writes first
+        fields = Columns(fields)
+    todo = Queue.Queue()
+    for i in range(slices if sliced else 1):
+        todo.put(i)
+
+    stop = threading.Event()
+    errors = []
+    lock = threading.Lock()
+    remaining = [limit]
+
+    def take(n):
+        # how many of the next n records can still be written, if there is a limit
+        if remaining[0] is None:
+            return n
+        with lock:
+            n = min(n, remaining[0])
+            remaining[0] -= n
+            return n
+
+    def export_slice(i):
+        sq = q
+        if sliced:
+            sq = q.copy()
+            sq["slice"] = {"id" : i, "max" : slices}
+        writer = SplitWriter(path, format, codec, i if sliced else None, max_bytes, max_records, compress,
+                             compress_level, buffer_size, fields)
+        pages = tasks._scroll_pages(conn, type, sq, keepalive)
+        try:
+            for results in pages:
+                if stop.is_set():
+                    break
+                n = take(len(results))
+                for r in results[:n]:
+                    writer.write(transform(r) if transform is not None else r)
+                if n < len(results):
+                    break
+        finally:
+            pages.close()
+            writer.close()
+            with lock:
+                stats.add(writer)
+
+    def work():
+        while not stop.is_set():
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                export_slice(i)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                stop.set()
+
+    if not sliced:
+        work()
+    else:
+        threads = [threading.Thread(target=work) for _ in range(workers if workers is not None else slices)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    stats.finish()
+    if len(errors) > 0:
+        raise errors[0]
+    return stats
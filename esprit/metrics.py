@@ -0,0 +1,174 @@
+# Hooks for Connection.add_hook which keep track of where the time goes: per-endpoint latency
+# histograms and throughput, and a log of slow requests
+
+import threading, time, logging
+
+class Hook(object):
+    """
+    A hook which does nothing; subclass it and override whichever of the two methods you need
+    """
+    def before_request(self, event):
+        pass
+
+    def after_request(self, event):
+        pass
+
+# upper bounds of the latency buckets, in seconds.  Anything slower goes in a final bucket
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0]
+
+class LatencyHistogram(object):
+    """
+    Counts of requests by how long they took, in the buckets given by bounds
+    """
+    def __init__(self, bounds=None):
+        self.bounds = bounds if bounds is not None else LATENCY_BUCKETS
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        i = 0
+        while i < len(self.bounds) and seconds > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket holding the pth percentile (0-100), or the slowest time
+        seen if that is less (or the percentile is in the last bucket)
+        """
+        if self.count == 0:
+            return 0.0
+        target = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                # no slower than anything actually seen, even if the bucket goes higher
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def as_dict(self):
+        buckets = dict((str(b), c) for b, c in zip(self.bounds, self.counts))
+        buckets["+inf"] = self.counts[-1]
+        return {
+            "count" : self.count,
+            "mean" : self.mean,
+            "max" : self.max,
+            "p50" : self.percentile(50),
+            "p95" : self.percentile(95),
+            "p99" : self.percentile(99),
+            "buckets" : buckets
+        }
+
+class EndpointStats(object):
+    def __init__(self, bounds=None):
+        self.latency = LatencyHistogram(bounds)
+        self.errors = 0
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.took = 0
+        self.took_count = 0
+
+    def add(self, event):
+        self.latency.add(event["seconds"])
+        status = event.get("status")
+        if event.get("error") is not None or status is None or status >= 400:
+            self.errors += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes_sent += event.get("bytes_sent") or 0
+        self.bytes_received += event.get("bytes_received") or 0
+        if event.get("took") is not None:
+            self.took += event["took"]
+            self.took_count += 1
+
+    def as_dict(self, elapsed):
+        d = self.latency.as_dict()
+        d.update({
+            "errors" : self.errors,
+            "statuses" : self.statuses.copy(),
+            "bytes_sent" : self.bytes_sent,
+            "bytes_received" : self.bytes_received,
+            "requests_per_second" : self.latency.count / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_second" : (self.bytes_sent + self.bytes_received) / elapsed if elapsed > 0 else 0.0,
+            "took_ms" : self.took,
+            "mean_took_ms" : float(self.took) / self.took_count if self.took_count > 0 else None
+        })
+        return d
+
+class RequestMetrics(Hook):
+    """
+    Aggregates every request by endpoint (see raw.describe_url): a latency histogram, counts of
+    statuses and errors, bytes each way, throughput since the metrics were started or reset, and
+    the total of the took times ElasticSearch reported.  The difference between the mean latency
+    and the mean took is the time spent outside ElasticSearch's own search, on the network and in
+    (de)serialisation
+    """
+    def __init__(self, bounds=None):
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.started = time.time()
+
+    def after_request(self, event):
+        with self._lock:
+            stats = self.endpoints.get(event["endpoint"])
+            if stats is None:
+                stats = EndpointStats(self.bounds)
+                self.endpoints[event["endpoint"]] = stats
+            stats.add(event)
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.started
+            return dict((endpoint, stats.as_dict(elapsed)) for endpoint, stats in self.endpoints.items())
+
+    def __str__(self):
+        lines = []
+        for endpoint, d in sorted(self.summary().items()):
+            lines.append("{e}: {n} requests, {x} errors, mean {m:.3f}s, p95 {p:.3f}s, max {a:.3f}s, {r:.1f} req/s, {s} bytes sent, {b} bytes received".format(
+                e=endpoint, n=d["count"], x=d["errors"], m=d["mean"], p=d["p95"], a=d["max"], r=d["requests_per_second"],
+                s=d["bytes_sent"], b=d["bytes_received"]))
+        return "\n".join(lines)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+class SlowQueryLog(Hook):
+    """
+    Reports any request which takes longer than threshold seconds, to callback(event) if one is
+    given, otherwise as a warning on the given logger (or logger name)
+    """
+    def __init__(self, threshold=1.0, callback=None, logger="esprit.slow"):
+        self.threshold = threshold
+        self.callback = callback
+        self.logger = logger
+
+    def after_request(self, event):
+        if event["seconds"] < self.threshold:
+            return
+        if self.callback is not None:
+            self.callback(event)
+        else:
+            logger = logging.getLogger(self.logger) if isinstance(self.logger, str) else self.logger
+            logger.warning("slow request: %s %s took %.3fs (ElasticSearch took %sms, status %s)",
+                           event["method"], event["url"], event["seconds"], event.get("took"), event.get("status"))
@@ -1,8 +1,94 @@
-from copy import deepcopy
-import string
+import string, threading, itertools
+from collections import OrderedDict
 
 unicode_punctuation_map = dict((ord(char), None) for char in string.punctuation)
 
+class Param(object):
+    """
+    A named slot in a QueryTemplate, which may stand for a value or a key
+    """
+    __slots__ = ["name"]
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "Param(" + repr(self.name) + ")"
+
+def _compile(structure):
+    # generate the source of a single expression which builds the structure from the params, so
+    # that filling it in runs at the speed of a literal, with no copying or inspecting to do
+    constants = []
+    def source(node):
+        if isinstance(node, Param):
+            return "p[" + repr(node.name) + "]"
+        if isinstance(node, dict):
+            return "{" + ", ".join([source(k) + " : " + source(v) for k, v in node.items()]) + "}"
+        if isinstance(node, list):
+            return "[" + ", ".join([source(v) for v in node]) + "]"
+        # anything else is a constant, which is shared between fills
+        constants.append(node)
+        return "c[" + str(len(constants) - 1) + "]"
+    return eval("lambda p: " + source(structure), {"c" : constants})
+
+_SCALARS = (type(u""), str, bool, int, float, type(None))
+
+def _memo_key(params):
+    # a hashable key for params (a dict, or a list) whose values are all strings, numbers, booleans
+    # or None, which is only equal to another's if they would serialise the same (so True and 1 are
+    # kept apart).  Anything else isn't worth the memo: working out a key for it costs more than
+    # serialising it
+    if isinstance(params, dict):
+        key = []
+        for k, v in params.items():
+            if not isinstance(v, _SCALARS):
+                return None
+            key.append((k, v.__class__, v))
+        key.sort()
+        return tuple(key)
+    for v in params:
+        if not isinstance(v, _SCALARS):
+            return None
+    return tuple([(v.__class__, v) for v in params])
+
+class QueryTemplate(object):
+    """
+    A query structure of dicts, lists, constants and Params, compiled once so that each fill()
+    builds a fresh copy with the Params filled in, far more cheaply than deepcopying a template
+    and then changing it.  dumpb() gives the serialised body, and remembers the last memo_size
+    of them where the params are all simple values, so a query which is repeated with the same
+    params is only serialised once
+    """
+    def __init__(self, structure, memo_size=256):
+        # constants in the structure are shared by every query filled from it, so should be
+        # strings, numbers, booleans or None
+        self.structure = structure
+        self.memo_size = memo_size
+        self._build = _compile(structure)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fill(self, params=None):
+        return self._build(params if params is not None else {})
+
+    def dumpb(self, codec, params=None):
+        params = params if params is not None else {}
+        key = _memo_key(params)
+        if key is None:
+            return codec.dumpb(self._build(params))
+        key = (codec.name, key)
+        with self._lock:
+            body = self._memo.pop(key, None)
+            if body is not None:
+                self._memo[key] = body
+                return body
+        body = codec.dumpb(self._build(params))
+        with self._lock:
+            self._memo[key] = body
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return body
+
 class Query(object):
     def __init__(self, raw=None):
         self.q = QueryBuilder.match_all() if raw is None else raw
@@ -50,54 +136,42 @@ class Query(object):
         return self.q
 
 class QueryBuilder(object):
-    _match_all = { "query" : { "match_all" : {} }}
-    _query_string = {"query" : {"query_string" : {"query" : "<query string>"}}}
-    _term = {"query": {"term": { } } } # term : {"<key>" : "<value>"}
-    
-    _terms_filter = { "query" : { "filtered" : { "filter" : { "terms" : { } } } } } # terms : {"<key>" : ["<value>"]}
-    _term_filter = { "query" : { "filtered" : { "filter" : { "term" : { } } } } } # terms : {"<key>" : "<value>"}
+    _match_all = QueryTemplate({ "query" : { "match_all" : {} }})
+    _query_string = QueryTemplate({"query" : {"query_string" : {"query" : Param("query")}}})
+    _term = QueryTemplate({"query": {"term": {Param("key") : Param("value")} } })
     
-    _fields_constraint = {"fields" : []}
+    _terms_filter = QueryTemplate({ "query" : { "filtered" : { "filter" : { "terms" : {Param("key") : Param("values")} } } } })
+    _term_filter = QueryTemplate({ "query" : { "filtered" : { "filter" : { "term" : {Param("key") : Param("value")} } } } })
     
     _special_chars = ["+", "-", "&&", "||", "!", "(", ")", "{", "}", "[", "]", "^", '"', "~", "*", "?", ":", "/"]
     _escape_char = "\\" # which is a special special character too!
     
     @classmethod
     def match_all(cls):
-        return deepcopy(cls._match_all)
+        return cls._match_all.fill()
     
     @classmethod
     def query_string(cls, query):
-        q = deepcopy(cls._query_string)
-        q["query"]["query_string"]["query"] = query
-        return q
+        return cls._query_string.fill({"query" : query})
         
     @classmethod
     def term(cls, key, value):
-        q = deepcopy(cls._term) 
-        q["query"]["term"][key] = value
-        return q
+        return cls._term.fill({"key" : key, "value" : value})
     
     @classmethod
     def term_filter(cls, key, value):
-        q = deepcopy(cls._term_filter)
-        q["query"]["filtered"]["filter"]["term"][key] = value
-        return q
+        return cls._term_filter.fill({"key" : key, "value" : value})
     
     @classmethod
     def terms_filter(cls, key, values):
         if not isinstance(values, list):
             values = [values]
-        q = deepcopy(cls._terms_filter)
-        q["query"]["filtered"]["filter"]["terms"][key] = values
-        return q
+        return cls._terms_filter.fill({"key" : key, "values" : values})
     
     @classmethod
     def fields(cls, query, fields=None):
         fields = [] if fields is None else fields if isinstance(fields, list) else [fields]
-        fc = deepcopy(cls._fields_constraint)
-        fc["fields"] = fields
-        query.update(fc)
+        query["fields"] = fields
         return query
 
     @classmethod
@@ -116,3 +190,142 @@ class QueryBuilder(object):
         for sc in cls._special_chars:
             qs = qs.replace(sc, cls._escape_char + sc)
         return qs
+
+class QueryCompiler(object):
+    """
+    Builds the search bodies for DomainObject.query and dataformat_query from their arguments
+    (a query string or query dict, terms, should_terms, facets and any other top level keys).
+    Each combination of argument shapes - which term keys and how many values each, which
+    should terms, facets and other keys - is compiled to a QueryTemplate the first time it is
+    seen, and afterwards only the values are filled in.  Nothing that is passed in is changed
+    """
+    def __init__(self, max_templates=512, memo_size=64):
+        self.max_templates = max_templates
+        self.memo_size = memo_size
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+        self._whole = QueryTemplate(Param(0), memo_size=0)
+
+    def compile(self, q='', terms=None, should_terms=None, facets=None, **kwargs):
+        """
+        The template for these arguments, and the params to fill it with
+        """
+        if isinstance(q, dict) and not terms and not should_terms and not facets and not kwargs:
+            # the caller has already built the query; all that's left is to make it a bool query,
+            # which is cheaper done directly than by taking it apart to fill a template
+            body = dict(q)
+            body["query"] = _bool_query(q["query"])
+            return self._whole, [body]
+
+        # the params are a list, in the order _structure numbers them: the term values, the query
+        # string or query, the should clauses, the query's other keys, the facets and the kwargs
+        params = []
+        kind = "dict" if isinstance(q, dict) else "string" if q else "none"
+
+        term_shape = []
+        if terms:
+            for key in sorted(terms.keys()):
+                values = terms[key] if isinstance(terms[key], list) else [terms[key]]
+                term_shape.append((key, len(values)))
+                params.extend(values)
+
+        should = []
+        if should_terms:
+            for key in sorted(should_terms.keys()):
+                values = should_terms[key] if isinstance(should_terms[key], list) else [should_terms[key]]
+                should.append({"terms" : {key : values}})
+
+        extra_keys = []
+        all_facets = {}
+        if kind == "dict":
+            if len(term_shape) == 0:
+                # the must clauses are the caller's own, so any should terms join them there
+                params.append(_bool_query(q["query"], should))
+                should = []
+            else:
+                params.append(_bool_query(q["query"]))
+            extra_keys = sorted([k for k in q.keys() if k != "query" and k != "facets"])
+            all_facets.update(q.get("facets", {}))
+        elif kind == "string":
+            params.append(q)
+        params.extend(should)
+        params.extend([q[k] for k in extra_keys])
+
+        if facets:
+            for k, v in facets.items():
+                all_facets[k] = {"terms" : v}
+        facet_keys = sorted(all_facets.keys())
+        params.extend([all_facets[k] for k in facet_keys])
+
+        kwarg_keys = []
+        if kwargs:
+            named = dict([("from" if k == "_from" else k, v) for k, v in kwargs.items()])
+            kwarg_keys = sorted(named.keys())
+            params.extend([named[k] for k in kwarg_keys])
+
+        shape = (kind, tuple(term_shape), len(should), tuple(facet_keys), tuple(extra_keys), tuple(kwarg_keys))
+        template = self._templates.get(shape)
+        if template is None:
+            template = QueryTemplate(self._structure(*shape), memo_size=self.memo_size)
+            with self._lock:
+                self._templates[shape] = template
+                # the oldest shapes make way for new ones
+                while len(self._templates) > self.max_templates:
+                    self._templates.popitem(last=False)
+        return template, params
+
+    def build(self, *args, **kwargs):
+        """
+        The query dict for the same arguments as compile
+        """
+        template, params = self.compile(*args, **kwargs)
+        return template.fill(params)
+
+    def _structure(self, kind, term_shape, should_count, facet_keys, extra_keys, kwarg_keys):
+        slots = itertools.count()
+        terms = [(key, [Param(next(slots)) for _ in range(count)]) for key, count in term_shape]
+        inner = Param(next(slots)) if kind != "none" else None
+        should = [Param(next(slots)) for _ in range(should_count)]
+        extras = [(k, Param(next(slots))) for k in extra_keys]
+        facets = [(k, Param(next(slots))) for k in facet_keys]
+        kwarg_params = [(k, Param(next(slots))) for k in kwarg_keys]
+
+        if kind == "dict" and len(term_shape) == 0:
+            query = inner
+        else:
+            must = []
+            for key, values in terms:
+                for v in values:
+                    must.append({"term" : {key : v}})
+            if kind == "string":
+                must.append({"query_string" : {"query" : inner}})
+            elif kind == "dict":
+                must.append(inner)
+            elif len(term_shape) == 0:
+                must.append({"match_all" : {}})
+            must.extend(should)
+            query = {"bool" : {"must" : must}}
+
+        structure = dict(extras)
+        structure["query"] = query
+        if len(facets) > 0:
+            structure["facets"] = dict(facets)
+        # anything else asked for goes in last, so it can override the rest
+        for k, v in kwarg_params:
+            structure[k] = v
+        return structure
+
+def _bool_query(query, extra_must=None):
+    # the query as a bool with a must list, with any extra clauses on the end of that list,
+    # copying only what has to change so that the caller's query is left as it was
+    if "bool" not in query:
+        return {"bool" : {"must" : [query] + (extra_must or [])}}
+    if "must" in query["bool"] and not extra_must:
+        return query
+    must = query["bool"].get("must", [])
+    must = must if isinstance(must, list) else [must]
+    boolean = dict(query["bool"])
+    boolean["must"] = must + (extra_must or [])
+    wrapped = dict(query)
+    wrapped["bool"] = boolean
+    return wrapped
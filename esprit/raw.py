@@ -1,7 +1,18 @@
 # The Raw ElasticSearch functions, no frills, just wrappers around the HTTP calls
 
-import requests, json, urllib
-from models import QueryBuilder
+import requests, threading, time, zlib, itertools, random, re, os, weakref
+import requests.adapters
+from esprit.models import QueryBuilder
+from esprit import codec as json_codec
+try:
+    import ijson
+    import ijson.common
+except ImportError:
+    ijson = None
+try:
+    from urllib import quote_plus
+except ImportError:
+    from urllib.parse import quote_plus
 
 class ESWireException(Exception):
     def __init__(self, value):
@@ -13,21 +24,560 @@ class ESWireException(Exception):
 ## Connection to the index
 
 class Connection(object):
-    def __init__(self, host, index, port=9200, auth=None, verify_ssl=True):
-        self.host = host
+    def __init__(self, host, index, port=9200, auth=None, verify_ssl=True,
+                 pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, timeout=None, codec=None,
+                 compression=None, compression_threshold=1024, compression_level=6, accept_compression=True,
+                 selector=None, dead_timeout=60, health_check_interval=10, sniff=False, sniff_interval=300,
+                 retry=None, hooks=None, es_version=None, metadata_ttl=300):
+        # host may be a list of nodes ("es1", "es1:9201", "https://es1:9201"), in which case
+        # requests are spread across them.  The first is the one the connection is known by
+        hosts = host if isinstance(host, (list, tuple)) else [host]
+        if len(hosts) == 0:
+            raise ValueError("at least one host is needed")
+        self.nodes = [Node(*_split_host(h, port)) for h in hosts]
+        self.host = self.nodes[0].host
         self.index = index
-        self.port = port
+        self.port = self.nodes[0].port
         self.auth = auth
         self.verify_ssl = verify_ssl
-        
-        # make sure that host starts with "http://" or equivalent
-        if not self.host.startswith("http"):
-            self.host = "http://" + self.host
-        
-        # some people might tack the port onto the host
-        if len(self.host.split(":")) > 2:
-            self.port = self.host[self.host.rindex(":") + 1:]
-            self.host = self.host[:self.host.rindex(":")]
+
+        # the json codec (or codec name, see esprit.codec) for this connection's requests and
+        # responses.  If None, the global default is used
+        if codec is not None and not isinstance(codec, json_codec.JSONCodec):
+            codec = json_codec.get(codec)
+        self.codec = codec
+
+        # connection pool settings.  pool_connections is the number of distinct hosts to keep
+        # pools for, pool_maxsize is the number of keep-alive connections held per host, and
+        # pool_block stops more than pool_maxsize connections being opened to any one host
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+
+        # request bodies of at least compression_threshold bytes are sent compressed with the
+        # given Content-Encoding (COMPRESSION_GZIP or COMPRESSION_DEFLATE), and compressed
+        # responses are asked for unless accept_compression is False.  What it saves is totted
+        # up in compression_stats
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("unknown compression '" + str(compression) + "'; use one of " + ", ".join(COMPRESSIONS))
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.accept_compression = accept_compression
+        self.compression_stats = CompressionStats()
+
+        # node selection and failover, for connections with more than one node (or which sniff
+        # for them).  selector is SELECT_ROUND_ROBIN or SELECT_LEAST_OUTSTANDING; a node which
+        # can't be connected to is left out for dead_timeout seconds, or until the background
+        # health check (every health_check_interval seconds, None for no checks) finds it up
+        # again.  With sniff, the cluster's other http nodes are found from _nodes/http every
+        # sniff_interval seconds
+        if selector is None:
+            selector = SELECT_ROUND_ROBIN
+        if selector not in SELECTORS:
+            raise ValueError("unknown node selector '" + str(selector) + "'; use one of " + ", ".join(SELECTORS))
+        self.selector = selector
+        self.dead_timeout = dead_timeout
+        self.health_check_interval = health_check_interval
+        self.sniff = sniff
+        self.sniff_interval = sniff_interval
+        self.last_sniff = None
+        self._next_node = 0
+
+        # a RetryPolicy for requests (and bulk items) which the cluster pushes back on
+        self.retry = retry
+
+        # objects told about every request, see add_hook
+        self.hooks = list(hooks) if hooks is not None else []
+
+        # the ElasticSearch version to talk to; if None, the cluster is asked the first time it
+        # matters (see server_version).  Whether indexes, types and mappings exist is remembered
+        # in metadata for metadata_ttl seconds
+        self.es_version = es_version
+        self.metadata = ClusterMetadata(metadata_ttl)
+
+        self._init_pool()
+        self._init_nodes()
+
+    def _init_pool(self):
+        # one adapter (and therefore one urllib3 connection pool) is shared by all the sessions,
+        # and each thread gets its own session so that no session state is shared between threads.
+        # The sessions are only held weakly here, so a thread's session goes when the thread does
+        self._adapter = None
+        self._sessions = weakref.WeakSet()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def session(self):
+        if self._closed:
+            raise ESWireException("connection to '" + str(self.host) + "' has been closed")
+        s = getattr(self._local, "session", None)
+        if s is not None:
+            return s
+        with self._lock:
+            if self._adapter is None:
+                self._adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_connections,
+                                                              pool_maxsize=self.pool_maxsize,
+                                                              pool_block=self.pool_block)
+            s = requests.Session()
+            s.mount("http://", self._adapter)
+            s.mount("https://", self._adapter)
+            if not self.keep_alive:
+                s.headers["Connection"] = "close"
+            if not self.accept_compression:
+                s.headers["Accept-Encoding"] = "identity"
+            self._sessions.add(s)
+        self._local.session = s
+        return s
+
+    def add_hook(self, hook):
+        """
+        Have hook told about each request this connection makes.  Its before_request(event) is
+        called with a dict of method, url, endpoint, index and type, and its after_request(event)
+        with the same dict once the response is back, now also holding status, bytes_sent,
+        bytes_received, seconds, took (as reported by ElasticSearch), attempts, and any error
+        raised.  Either method may be left out; see esprit.metrics for some ready-made hooks
+        """
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _init_nodes(self):
+        self._nodes_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._maintenance = None
+
+    @property
+    def multi_node(self):
+        return len(self.nodes) > 1 or self.sniff
+
+    def select_node(self):
+        """
+        Choose the node for the next request, and count it as outstanding until release_node.
+        If every node is dead, the one due to be revived soonest is tried anyway
+        """
+        self._start_maintenance()
+        now = time.time()
+        with self._nodes_lock:
+            alive = [n for n in self.nodes if n.dead_until is None or n.dead_until <= now]
+            if len(alive) == 0:
+                node = min(self.nodes, key=lambda n: n.dead_until)
+            elif self.selector == SELECT_LEAST_OUTSTANDING:
+                node = min(alive, key=lambda n: n.outstanding)
+            else:
+                node = alive[self._next_node % len(alive)]
+                self._next_node += 1
+            node.outstanding += 1
+        return node
+
+    def release_node(self, node):
+        with self._nodes_lock:
+            node.outstanding -= 1
+
+    def mark_dead(self, node):
+        with self._nodes_lock:
+            node.failures += 1
+            node.dead_until = time.time() + self.dead_timeout
+
+    def mark_alive(self, node):
+        if node.dead_until is None and node.failures == 0:
+            return
+        with self._nodes_lock:
+            node.failures = 0
+            node.dead_until = None
+
+    def health_check(self):
+        """
+        Try each dead node, and bring back any which answer
+        """
+        for node in [n for n in self.nodes if n.dead_until is not None]:
+            try:
+                resp = self.session().get(node.url + "/", auth=self.auth, verify=self.verify_ssl,
+                                          timeout=self.timeout if self.timeout is not None else 5)
+            except requests.RequestException:
+                self.mark_dead(node)
+                continue
+            if resp.status_code < 500:
+                self.mark_alive(node)
+
+    def sniff_nodes(self):
+        """
+        Add any http nodes in the cluster which this connection doesn't know about yet
+        """
+        self.last_sniff = time.time()
+        resp = _do_get(elasticsearch_url(self, endpoint="_nodes/http", omit_index=True), self)
+        if resp.status_code != 200:
+            return
+        scheme = self.host[:self.host.index("://") + 3]
+        found = []
+        for info in decode(resp).get("nodes", {}).values():
+            address = info.get("http", {}).get("publish_address")
+            if address is None:
+                continue
+            # ES 7 gives "hostname/ip:port"; the ip is the one to use
+            address = address.split("/")[-1]
+            found.append(Node(*_split_host(scheme + address, self.port)))
+        with self._nodes_lock:
+            known = set(n.url for n in self.nodes)
+            self.nodes = self.nodes + [n for n in found if n.url not in known]
+
+    def _start_maintenance(self):
+        if self._maintenance is not None or self.health_check_interval is None or not self.multi_node:
+            return
+        with self._nodes_lock:
+            if self._maintenance is not None:
+                return
+            # the thread only holds the connection weakly, so that it doesn't keep an abandoned
+            # connection alive; it stops once the connection has gone
+            stop = self._stop
+            ref = weakref.ref(self, lambda r: stop.set())
+            self._maintenance = threading.Thread(target=_maintain, args=(ref, stop), name="esprit-health-check")
+            self._maintenance.daemon = True
+            self._maintenance.start()
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            self._closed = True
+            for s in list(self._sessions):
+                s.close()
+            self._sessions = weakref.WeakSet()
+            if self._adapter is not None:
+                self._adapter.close()
+                self._adapter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getstate__(self):
+        # the pool can't be pickled or shared between processes; a copy gets a pool of its own
+        state = self.__dict__.copy()
+        for k in ["_adapter", "_sessions", "_local", "_lock", "_closed", "_nodes_lock", "_stop", "_maintenance"]:
+            state.pop(k, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_pool()
+        self._init_nodes()
+
+def _maintain(ref, stop):
+    # the health check thread of the connection ref refers to
+    while not stop.is_set():
+        conn = ref()
+        if conn is None:
+            return
+        try:
+            if conn.sniff and (conn.last_sniff is None or time.time() - conn.last_sniff >= conn.sniff_interval):
+                conn.sniff_nodes()
+            conn.health_check()
+        except Exception:
+            # the checks are best effort; the next round will try again
+            pass
+        interval = conn.health_check_interval
+        conn = None
+        stop.wait(interval)
+
+class ClusterMetadata(object):
+    """
+    What a connection has found out about the cluster: its version, which is kept until the
+    metadata is cleared, and which indexes, types and mappings exist, which is kept for ttl
+    seconds (or for good if ttl is None); those found not to exist aren't kept.  The raw functions
+    keep it up to date with the changes they make; anything else which creates or deletes indexes,
+    types or mappings should invalidate what it affects
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, index, type=None):
+        """
+        Whether the index, type or mapping (kind is "index", "type" or "mapping") is known to
+        exist, or None if it isn't known
+        """
+        key = (kind, _index_key(index), type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def set(self, kind, index, type, exists):
+        with self._lock:
+            self._entries[(kind, _index_key(index), type)] = (exists, time.time())
+
+    def invalidate(self, index=None, type=None):
+        """
+        Forget what is known about the given index (or type of it), or about every index
+        """
+        index = _index_key(index) if index is not None else None
+        with self._lock:
+            for kind, i, t in list(self._entries.keys()):
+                if index is not None and i != index:
+                    continue
+                if type is not None and (kind == "index" or t != type):
+                    continue
+                del self._entries[(kind, i, t)]
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.version = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+def _index_key(index):
+    return ",".join(index) if isinstance(index, list) else index
+
+RETRY_STATUSES = [429, 503]
+
+class RetryPolicy(object):
+    """
+    When and how often to retry requests that the cluster pushes back on.  A request which gets
+    one of the statuses is made up to max_attempts times in all, waiting backoff * 2 ** (n - 1)
+    seconds (at most max_backoff) before the nth retry, or longer if a Retry-After header asks.
+    With jitter each wait is a random time up to that, so that clients rejected together don't
+    all come back together.  Bulk items rejected with one of the statuses are resent on their
+    own.  The counts of what was retried are kept on the policy (see stats)
+    """
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30, jitter=True, statuses=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses if statuses is not None else RETRY_STATUSES
+
+        self.retries = 0
+        self.bulk_items_retried = 0
+        self.gave_up = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, retry_after=None):
+        d = min(self.max_backoff, self.backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            d = random.uniform(0, d)
+        if retry_after is not None:
+            try:
+                d = max(d, min(self.max_backoff, float(retry_after)))
+            except ValueError:
+                # an http date rather than a number of seconds; stick with our own backoff
+                pass
+        return d
+
+    def wait(self, attempt, retry_after=None):
+        d = self.delay(attempt, retry_after)
+        self.record(waited=d)
+        time.sleep(d)
+
+    def record(self, retries=0, bulk_items=0, gave_up=0, waited=0.0):
+        with self._lock:
+            self.retries += retries
+            self.bulk_items_retried += bulk_items
+            self.gave_up += gave_up
+            self.waited += waited
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retries" : self.retries,
+                "bulk_items_retried" : self.bulk_items_retried,
+                "gave_up" : self.gave_up,
+                "waited" : self.waited
+            }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+SELECT_ROUND_ROBIN = "round_robin"
+SELECT_LEAST_OUTSTANDING = "least_outstanding"
+SELECTORS = [SELECT_ROUND_ROBIN, SELECT_LEAST_OUTSTANDING]
+
+class Node(object):
+    """
+    One ElasticSearch node of a Connection, with the state used to choose between them
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.url = node_url(host, port)
+        self.outstanding = 0
+        self.failures = 0
+        self.dead_until = None
+
+    @property
+    def alive(self):
+        return self.dead_until is None or self.dead_until <= time.time()
+
+    def __repr__(self):
+        return "Node(" + self.url + (")" if self.alive else ", dead)")
+
+def _split_host(host, port):
+    # make sure that host starts with "http://" or equivalent
+    if not host.startswith("http"):
+        host = "http://" + host
+
+    # some people might tack the port onto the host
+    if len(host.split(":")) > 2:
+        port = host[host.rindex(":") + 1:]
+        host = host[:host.rindex(":")]
+    return host, port
+
+def node_url(host, port):
+    # normalise the host
+    if not host.startswith("http"):
+        host = "http://" + host
+    if host.endswith("/"):
+        host = host[:-1]
+
+    if port is not None:
+        host += ":" + str(port)
+    return host
+
+####################################################################
+## Compression
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSIONS = [COMPRESSION_GZIP, COMPRESSION_DEFLATE]
+
+class CompressionStats(object):
+    """
+    Running totals of the compression done on a connection's requests, and of the compressed
+    responses it has received
+    """
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.sent = 0
+        self.seconds = 0.0
+        self.responses = 0
+        self.received = 0
+        self.decoded = 0
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            if record.get("encoding") is not None:
+                self.requests += 1
+                self.bytes += record["bytes"]
+                self.sent += record["sent"]
+                self.seconds += record["seconds"]
+            if record.get("response_encoding") is not None:
+                self.responses += 1
+                self.received += record["received"]
+                self.decoded += record["decoded"]
+
+    @property
+    def saved(self):
+        return (self.bytes - self.sent) + (self.decoded - self.received)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "compressed {r} requests from {b} to {s} bytes in {t:.3f}s, received {n} compressed responses of {d} bytes in {w} bytes, saved {v} bytes".format(
+            r=self.requests, b=self.bytes, s=self.sent, t=self.seconds, n=self.responses, d=self.decoded, w=self.received, v=self.saved)
+
+def _compressor(encoding, level):
+    # http's "deflate" is the zlib format; gzip is the same stream with a gzip header instead
+    wbits = 31 if encoding == COMPRESSION_GZIP else 15
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+def compress_body(connection, data):
+    """
+    Compress a request body according to the connection's settings.  Returns the body to send
+    and a record of the compression, which is None if the body is being sent as it is.  A body
+    given as a generator is compressed as it is sent, so its record is only complete once the
+    request has been made
+    """
+    encoding = getattr(connection, "compression", None)
+    if encoding is None or data is None:
+        return data, None
+    threshold = connection.compression_threshold
+
+    if isinstance(data, bytes):
+        if len(data) < threshold:
+            return data, None
+        start = time.time()
+        c = _compressor(encoding, connection.compression_level)
+        body = c.compress(data) + c.flush()
+        elapsed = time.time() - start
+        if len(body) >= len(data):
+            return data, None
+        return body, {"encoding" : encoding, "bytes" : len(data), "sent" : len(body), "saved" : len(data) - len(body), "seconds" : elapsed}
+
+    if isinstance(data, (dict, list, type(u""))) or not hasattr(data, "__iter__") or hasattr(data, "read"):
+        # form data, files and the like go as they are
+        return data, None
+
+    # read far enough into the generator to know whether it reaches the threshold
+    it = iter(data)
+    head = []
+    size = 0
+    for chunk in it:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= threshold:
+            break
+    else:
+        return b"".join(head), None
+
+    record = {"encoding" : encoding, "bytes" : 0, "sent" : 0, "saved" : 0, "seconds" : 0.0}
+    def compressed():
+        c = _compressor(encoding, connection.compression_level)
+        for chunk in itertools.chain(head, it):
+            start = time.time()
+            out = c.compress(chunk)
+            record["seconds"] += time.time() - start
+            record["bytes"] += len(chunk)
+            # an empty chunk would end a chunked body early, so only send what the compressor gives back
+            if out:
+                record["sent"] += len(out)
+                yield out
+        start = time.time()
+        out = c.flush()
+        record["seconds"] += time.time() - start
+        record["sent"] += len(out)
+        record["saved"] = record["bytes"] - record["sent"]
+        yield out
+    return compressed(), record
 
 def make_connection(connection, host, port, index, auth=None):
     if connection is not None:
@@ -56,15 +606,7 @@ def elasticsearch_url(connection, type=None, endpoint=None, params=None, omit_in
     if isinstance(type, list):
         type = ",".join(type)
     
-    # normalise the host
-    if not host.startswith("http"):
-        host = "http://" + host
-    if host.endswith("/"):
-        host = host[:-1]
-    
-    if port is not None:
-        host += ":" + str(port)
-    host += "/"
+    host = node_url(host, port) + "/"
     
     url = host + index
     if type is not None and type != "":
@@ -78,55 +620,210 @@ def elasticsearch_url(connection, type=None, endpoint=None, params=None, omit_in
     # FIXME: NOT URL SAFE - do this properly
     if params is not None:
         args = []
-        for k, v in params.iteritems():
+        for k, v in params.items():
             args.append(k + "=" + v)
         q = "&".join(args)
         url += "?" + q
     
     return url
 
+###############################################################
+## JSON bodies
+
+def get_codec(connection):
+    codec = getattr(connection, "codec", None)
+    return codec if codec is not None else json_codec.default()
+
+def decode(requests_response):
+    """
+    The json body of a response, decoded straight from the bytes with the codec of the connection
+    it came from
+    """
+    codec = getattr(requests_response, "codec", None)
+    if codec is None:
+        codec = json_codec.default()
+    return codec.loads(requests_response.content)
+
 ###############################################################
 ## HTTP Requests
 
-def _do_head(url, conn, **kwargs):
+def describe_url(connection, url):
+    """
+    Split a url made by elasticsearch_url into the endpoint it calls (for example "_search",
+    "_search/scroll" or "doc" for a single record), the index and the type
+    """
+    base = node_url(connection.host, connection.port)
+    path = url[len(base):] if url.startswith(base) else url
+    segments = [p for p in path.split("?")[0].split("/") if p]
+    endpoint = None
+    for i, seg in enumerate(segments):
+        if seg.startswith("_"):
+            endpoint = seg
+            if seg == "_search" and len(segments) > i + 1 and segments[i + 1] == "scroll":
+                endpoint = "_search/scroll"
+            segments = segments[:i]
+            break
+    if endpoint is None:
+        endpoint = "doc" if len(segments) > 2 else "/"
+    index = segments[0] if len(segments) > 0 else None
+    type = segments[1] if len(segments) > 1 else None
+    return endpoint, index, type
+
+_TOOK = re.compile(br'"took"\s*:\s*(\d+)')
+_SCROLL_ID = re.compile(br'\s*\{\s*"_scroll_id"\s*:\s*"[^"]*"\s*,')
+
+def response_took(content):
+    # ElasticSearch puts took at the start of the body (after the scroll id, which may be hundreds
+    # of bytes long, in a scroll response), so there's no need to decode it all
+    start = 0
+    m = _SCROLL_ID.match(content)
+    if m is not None:
+        start = m.end()
+    m = _TOOK.search(content[start:start + 128])
+    return int(m.group(1)) if m is not None else None
+
+def _counted(data, event):
+    for chunk in data:
+        event["bytes_sent"] += len(chunk)
+        yield chunk
+
+def _fire(hooks, stage, event):
+    for hook in hooks:
+        fn = getattr(hook, stage, None)
+        if fn is not None:
+            fn(event)
+
+def _do_request(method, url, conn, **kwargs):
+    hooks = getattr(conn, "hooks", None)
+    if not hooks:
+        return _send_request(method, url, conn, **kwargs)
+
+    endpoint, index, doc_type = describe_url(conn, url)
+    event = {"method" : method, "url" : url, "endpoint" : endpoint, "index" : index, "type" : doc_type}
+    _fire(hooks, "before_request", event)
+
+    data = kwargs.get("data")
+    event["bytes_sent"] = 0
+    if isinstance(data, (bytes, type(u""))):
+        event["bytes_sent"] = len(data)
+    elif data is not None and not _resendable(data):
+        kwargs["data"] = _counted(data, event)
+
+    start = time.time()
+    try:
+        resp = _send_request(method, url, conn, **kwargs)
+    except Exception as e:
+        event.update({"status" : None, "bytes_received" : None, "seconds" : time.time() - start,
+                      "took" : None, "attempts" : None, "error" : e})
+        _fire(hooks, "after_request", event)
+        raise
+
+    event["seconds"] = time.time() - start
+    event["status"] = resp.status_code
+    event["attempts"] = resp.attempts
+    event["error"] = None
+    if resp.compression is not None and resp.compression.get("encoding") is not None:
+        event["bytes_sent"] = resp.compression["sent"]
+    if kwargs.get("stream"):
+        # the body hasn't been read yet
+        event["bytes_received"] = None
+        event["took"] = None
+    else:
+        wire_length = resp.headers.get("Content-Length")
+        event["bytes_received"] = int(wire_length) if wire_length is not None else len(resp.content)
+        event["took"] = response_took(resp.content)
+    _fire(hooks, "after_request", event)
+    return resp
+
+def _send_request(method, url, conn, **kwargs):
     if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
         kwargs["auth"] = conn.auth
     kwargs["verify"] = conn.verify_ssl
-    return requests.head(url, **kwargs)
+    if conn.timeout is not None and "timeout" not in kwargs:
+        kwargs["timeout"] = conn.timeout
+
+    record = None
+    if kwargs.get("data") is not None:
+        kwargs["data"], record = compress_body(conn, kwargs["data"])
+        if record is not None:
+            headers = dict(kwargs.get("headers") or {})
+            headers["Content-Encoding"] = record["encoding"]
+            kwargs["headers"] = headers
+
+    policy = getattr(conn, "retry", None)
+    attempt = 1
+    while True:
+        if getattr(conn, "multi_node", False):
+            resp = _do_node_request(method, url, conn, **kwargs)
+        else:
+            resp = conn.session().request(method, url, **kwargs)
+        if policy is None or resp.status_code not in policy.statuses:
+            break
+        if attempt >= policy.max_attempts or not _resendable(kwargs.get("data")):
+            policy.record(gave_up=1)
+            break
+        resp.close()
+        policy.wait(attempt, resp.headers.get("Retry-After"))
+        policy.record(retries=1)
+        attempt += 1
+    resp.attempts = attempt
+    # remember how to decode the body, for the unpack_* functions
+    resp.codec = get_codec(conn)
+
+    # a streamed body hasn't been read yet, so only its request side can be measured
+    response_encoding = resp.headers.get("Content-Encoding")
+    wire_length = resp.headers.get("Content-Length")
+    if response_encoding in COMPRESSIONS and wire_length is not None and not kwargs.get("stream"):
+        record = record if record is not None else {"encoding" : None}
+        record["response_encoding"] = response_encoding
+        record["received"] = int(wire_length)
+        record["decoded"] = len(resp.content)
+    resp.compression = record
+    if record is not None and hasattr(conn, "compression_stats"):
+        conn.compression_stats.add(record)
+    return resp
+
+def _resendable(data):
+    # a body that is being generated can't be sent twice
+    return data is None or isinstance(data, (bytes, type(u""), dict, list))
+
+def _do_node_request(method, url, conn, **kwargs):
+    # urls are built against the connection's first node; send each to whichever node is chosen,
+    # moving on to the next if it can't be connected to
+    base = node_url(conn.host, conn.port)
+    path = url[len(base):] if url.startswith(base) else None
+    resendable = _resendable(kwargs.get("data"))
+    attempts = 0
+    while True:
+        node = conn.select_node()
+        try:
+            resp = conn.session().request(method, node.url + path if path is not None else url, **kwargs)
+        except requests.ConnectionError:
+            conn.mark_dead(node)
+            attempts += 1
+            if not resendable or path is None or attempts >= len(conn.nodes):
+                raise
+            continue
+        finally:
+            conn.release_node(node)
+        conn.mark_alive(node)
+        return resp
+
+def _do_head(url, conn, **kwargs):
+    kwargs.setdefault("allow_redirects", False)
+    return _do_request("HEAD", url, conn, **kwargs)
 
 def _do_get(url, conn, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    return requests.get(url, **kwargs)
+    return _do_request("GET", url, conn, **kwargs)
 
 def _do_post(url, conn, data=None, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    return requests.post(url, data, **kwargs)
+    return _do_request("POST", url, conn, data=data, **kwargs)
 
 def _do_put(url, conn, data=None, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    return requests.put(url, data, **kwargs)
+    return _do_request("PUT", url, conn, data=data, **kwargs)
 
 def _do_delete(url, conn, **kwargs):
-    if conn.auth is not None:
-        if kwargs is None:
-            kwargs = {}
-        kwargs["auth"] = conn.auth
-    kwargs["verify"] = conn.verify_ssl
-    return requests.delete(url, **kwargs)
+    return _do_request("DELETE", url, conn, **kwargs)
 
 
 # 2016-11-09 TD : A new search interface returning different output formats, e.g. csv
@@ -136,7 +833,9 @@ def _do_delete(url, conn, **kwargs):
 ###############################################################
 ## Dataformat Search
 
-def data(connection, type=None, query=None, fmt="csv", method="POST", url_params=None):
+def data(connection, type=None, query=None, fmt="csv", method="POST", url_params=None, body=None, stream=False, offset=0):
+    # with stream the body is left to be read, by download() or otherwise, and with offset (which
+    # implies stream) the server is asked for it from that byte on
     if url_params is None:
         url_params = { "format" : fmt }
     elif not isinstance(url_params, dict):
@@ -145,48 +844,216 @@ def data(connection, type=None, query=None, fmt="csv", method="POST", url_params
         url_params["format"] = fmt
 
     url = elasticsearch_url(connection, type, "_data", url_params)
-    
-    if query is None:
-        query = QueryBuilder.match_all()
-    if not isinstance(query, dict):
-        query = QueryBuilder.query_string(query)
-    
+    body = _query_body(connection, query, body)
+
+    headers = {}
+    if offset:
+        stream = True
+        # byte offsets only line up if the body isn't content encoded on the way
+        headers["Range"] = "bytes=" + str(offset) + "-"
+        headers["Accept-Encoding"] = "identity"
+
     resp = None
     if method == "POST":
-        headers = {"content-type" : "application/json"}
-        resp = _do_post(url, connection, data=json.dumps(query), headers=headers)
+        headers["content-type"] = "application/json"
+        resp = _do_post(url, connection, data=body, headers=headers, stream=stream)
     elif method == "GET":
-        resp = _do_get(url + "&source=" + urllib.quote_plus(json.dumps(query)), connection)
+        resp = _do_get(url + "&source=" + quote_plus(body), connection, headers=headers, stream=stream)
     return resp
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+class DownloadProgress(object):
+    """
+    How far a download has got: bytes written by this download, starting from offset, out of
+    total (if the server said how long the body is) in chunks.  Passed to the progress callback
+    after each chunk, and returned at the end
+    """
+    def __init__(self, offset=0, total=None):
+        self.offset = offset
+        self.total = total
+        self.bytes = 0
+        self.chunks = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def position(self):
+        return self.offset + self.bytes
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        of = " of " + str(self.total) if self.total is not None else ""
+        return "downloaded {b} bytes in {c} chunks, to {p}{o}, in {s:.1f}s ({m:.2f} MB/s)".format(
+            b=self.bytes, c=self.chunks, p=self.position, o=of, s=self.elapsed, m=self.rate / 1048576.0)
+
+def download(resp, out, chunk_size=DOWNLOAD_CHUNK_SIZE, offset=0, progress=None):
+    """
+    Write the body of a streamed response to out in chunks of up to chunk_size bytes, so that it
+    is never all held in memory.  out may be a path, a file opened for writing bytes, or a
+    function which is given each chunk.  A path is written unbuffered, so each chunk goes
+    straight to the file.
+
+    offset says where the body starts from, when resuming a download which got that far before:
+    a path is truncated to offset and added to, and if the server sent the whole body rather
+    than the range asked for (see data()) the first offset bytes of it are skipped.  progress,
+    if given, is called with a DownloadProgress after each chunk, which is also returned
+    """
+    if resp.status_code not in [200, 206]:
+        resp.close()
+        raise ESWireException("download failed with status " + str(resp.status_code))
+
+    length = resp.headers.get("Content-Length")
+    partial = resp.status_code == 206
+    total = None
+    if length is not None:
+        total = int(length) + (offset if partial else 0)
+    stats = DownloadProgress(offset, total)
+    skip = offset if not partial else 0
+
+    f = None
+    try:
+        if isinstance(out, (str, type(u""))):
+            if offset:
+                if os.path.getsize(out) < offset:
+                    raise ESWireException("can't resume " + out + " from " + str(offset) + ", it is only " + str(os.path.getsize(out)) + " bytes")
+                f = open(out, "r+b", 0)
+                f.seek(offset)
+                f.truncate()
+            else:
+                f = open(out, "wb", 0)
+            write = f.write
+        elif hasattr(out, "write"):
+            write = out.write
+        else:
+            write = out
+
+        for chunk in resp.iter_content(chunk_size):
+            if skip > 0:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+            write(chunk)
+            stats.bytes += len(chunk)
+            stats.chunks += 1
+            if progress is not None:
+                progress(stats)
+    finally:
+        resp.close()
+        if f is not None:
+            f.close()
+    stats.finished = time.time()
+    return stats
+
+def data_download(connection, out, type=None, query=None, fmt="csv", method="POST", url_params=None, body=None,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE, offset=0, progress=None):
+    """
+    Run a dataformat query (see data) and write the result to out as it arrives, with download()
+    """
+    resp = data(connection, type, query, fmt, method, url_params, body, stream=True, offset=offset)
+    return download(resp, out, chunk_size, offset, progress)
+
 
 ###############################################################
 ## Regular Search
 
-def search(connection, type=None, query=None, method="POST", url_params=None):
+def search(connection, type=None, query=None, method="POST", url_params=None, stream=False, body=None):
+    # body is the query already serialised (see models.QueryTemplate), and is sent instead of query
     url = elasticsearch_url(connection, type, "_search", url_params)
-    
-    if query is None:
-        query = QueryBuilder.match_all()
-    if not isinstance(query, dict):
-        query = QueryBuilder.query_string(query)
-    
+    body = _query_body(connection, query, body)
+
     resp = None
     if method == "POST":
         headers = {"content-type" : "application/json"}
-        resp = _do_post(url, connection, data=json.dumps(query), headers=headers)
+        resp = _do_post(url, connection, data=body, headers=headers, stream=stream)
     elif method == "GET":
-        resp = _do_get(url + "?source=" + urllib.quote_plus(json.dumps(query)), connection)
+        resp = _do_get(url + "?source=" + quote_plus(body), connection, stream=stream)
     return resp
 
+def _query_body(connection, query, body):
+    if body is not None:
+        return body
+    if query is None:
+        query = QueryBuilder.match_all()
+    if not isinstance(query, dict):
+        query = QueryBuilder.query_string(query)
+    return get_codec(connection).dumpb(query)
+
 def unpack_result(requests_response):
-    j = requests_response.json()
+    j = decode(requests_response)
     return unpack_json_result(j)
 
 def unpack_json_result(j):
-    objects = [i.get("_source") if "_source" in i else i.get("fields") for i in j.get('hits', {}).get('hits', [])]
+    objects = [unpack_hit(i) for i in j.get('hits', {}).get('hits', [])]
     return objects
 
+def unpack_hit(hit):
+    return hit.get("_source") if "_source" in hit else hit.get("fields")
+
+class StreamedHits(object):
+    """
+    The hits of a search or scroll response requested with stream=True, parsed incrementally from
+    the body as they are iterated over, so that only one hit is held in memory at a time.  The
+    scroll id and total (which ES sends before the hits) are available as soon as the first hit
+    has been read, and count and last (the most recent hit) once they all have.  Needs ijson.
+
+    With sources=True the iteration gives the _source (or fields) of each hit, as unpack_result
+    does, rather than the hit itself.  The hits can only be iterated over once.
+    """
+    def __init__(self, requests_response, sources=False):
+        if ijson is None:
+            raise ESWireException("streamed responses need ijson to be installed")
+        self.response = requests_response
+        self.sources = sources
+        self.scroll_id = None
+        self.total = None
+        self.count = 0
+        self.last = None
+        self._read = False
+
+    def __iter__(self):
+        if self._read:
+            raise ESWireException("streamed hits can only be read once")
+        self._read = True
+
+        body = self.response.raw
+        body.decode_content = True
+        try:
+            events = ijson.parse(body, use_float=True)
+        except TypeError:
+            # older versions of ijson give floats as Decimals
+            events = ijson.parse(body)
+
+        try:
+            for prefix, event, value in events:
+                if prefix == "_scroll_id":
+                    self.scroll_id = value
+                elif prefix in ("hits.total", "hits.total.value") and event == "number":
+                    self.total = value
+                elif prefix == "hits.hits.item" and event == "start_map":
+                    # build this hit from its events, as ijson.items would
+                    builder = ijson.common.ObjectBuilder()
+                    while (prefix, event) != ("hits.hits.item", "end_map"):
+                        builder.event(event, value)
+                        prefix, event, value = next(events)
+                    self.count += 1
+                    self.last = builder.value
+                    yield unpack_hit(self.last) if self.sources else self.last
+        finally:
+            # if we stopped part way through, this drops the connection rather than reading the rest
+            self.response.close()
+
 def get_facet_terms(json_result, facet_name):
     return json_result.get("facets", {}).get(facet_name, {}).get("terms", [])
 
@@ -195,21 +1062,30 @@ def get_facet_terms(json_result, facet_name):
 
 # 2018-12-19 TD : raise default keepalive value to '10m'
 # def initialise_scroll(connection, type=None, query=None, keepalive="1m"):
-def initialise_scroll(connection, type=None, query=None, keepalive="10m"):
-    return search(connection, type, query, url_params={"scroll" : keepalive})
+def initialise_scroll(connection, type=None, query=None, keepalive="10m", stream=False):
+    return search(connection, type, query, url_params={"scroll" : keepalive}, stream=stream)
 
 # 2018-12-19 TD : see simply previous comment
 # def scroll_next(connection, scroll_id, keepalive="1m"):
-def scroll_next(connection, scroll_id, keepalive="10m"):
+def scroll_next(connection, scroll_id, keepalive="10m", stream=False):
     url = elasticsearch_url(connection, endpoint="_search/scroll", params={"scroll_id" : scroll_id, "scroll" : keepalive}, omit_index=True)
-    resp = _do_get(url, connection)
+    resp = _do_get(url, connection, stream=stream)
+    return resp
+
+def clear_scroll(connection, scroll_id):
+    url = elasticsearch_url(connection, endpoint="_search/scroll/" + scroll_id, omit_index=True)
+    resp = _do_delete(url, connection)
     return resp
 
 def scroll_timedout(requests_response):
-    return requests_response.status_code == 500
+    # whether the scroll context had gone: ES before 5.x says so with a 500, later versions with a 404
+    status = requests_response.status_code
+    if status == 500:
+        return True
+    return status == 404 and "searchcontextmissing" in requests_response.text.lower().replace("_", "")
 
 def unpack_scroll(requests_response):
-    j = requests_response.json()
+    j = decode(requests_response)
     objects = unpack_json_result(j)
     sid = j.get("_scroll_id")
     return objects, sid
@@ -223,32 +1099,113 @@ def get(connection, type, id):
     return resp
 
 def unpack_get(requests_response):
-    j = requests_response.json()
+    j = decode(requests_response)
     return j.get("_source")
 
 def mget(connection, type, ids, fields=None):
+    url, docs = mget_request(connection, type, ids, fields)
+    resp = _do_post(url, connection, data=get_codec(connection).dumpb(docs))
+    return resp
+
+def mget_request(connection, type, ids, fields=None):
+    # the url and docs of an mget.  With more than one type, each id is asked for in every type
+    # (id-major, in the order the types are given), and the types go in the docs rather than the url
+    types = type if isinstance(type, list) else [type]
+    if len(types) > 1:
+        return elasticsearch_url(connection, endpoint="_mget"), mget_docs(ids, fields, types)
+    return elasticsearch_url(connection, types[0], endpoint="_mget"), mget_docs(ids, fields)
+
+def mget_docs(ids, fields=None, types=None):
     if ids is None:
         raise ESWireException("mget requires one or more ids")
+    # the docs form is used even without fields, as the "ids" shorthand isn't understood by every ES version
+    if fields is not None:
+        fields = fields if isinstance(fields, list) else [fields]
     docs = {"docs" : []}
-    if fields is None:
-        docs = {"ids" : ids}
-    else:
-        fields = [] if fields is None else fields if isinstance(fields, list) else [fields]
-        for id in ids:
-            docs["docs"].append({"_id" : id, "fields" : fields})
-    url = elasticsearch_url(connection, type, endpoint="_mget")
-    resp = _do_post(url, connection, data=json.dumps(docs))
-    return resp
+    for id in ids:
+        for t in (types if types is not None else [None]):
+            doc = {"_id" : id}
+            if t is not None:
+                doc["_type"] = t
+            if fields is not None:
+                doc["fields"] = fields
+            docs["docs"].append(doc)
+    return docs
 
 def unpack_mget(requests_response):
-    j = requests_response.json()
+    j = decode(requests_response)
     objects = [i.get("_source") if "_source" in i else i.get("fields") for i in j.get("docs")]
     return objects
 
+####################################################################
+## Cluster metadata
+
+DEFAULT_ES_VERSION = "0.90.13"
+
+def server_version(connection):
+    """
+    The version of ElasticSearch the connection talks to: the es_version it was given, or else
+    the one the cluster reports, which is asked for once and then kept in the connection's
+    metadata.  If the cluster won't say, DEFAULT_ES_VERSION is assumed
+    """
+    if getattr(connection, "es_version", None) is not None:
+        return connection.es_version
+    metadata = getattr(connection, "metadata", None)
+    if metadata is not None and metadata.version is not None:
+        return metadata.version
+
+    version = DEFAULT_ES_VERSION
+    resp = _do_get(node_url(connection.host, connection.port) + "/", connection)
+    if resp.status_code == 200:
+        version = decode(resp).get("version", {}).get("number", version)
+    if metadata is not None:
+        metadata.version = version
+    return version
+
+def _version(connection, es_version):
+    return es_version if es_version is not None else server_version(connection)
+
+def _known(connection, kind, type, use_cache, check):
+    # whether the index, type or mapping exists, from the connection's metadata if it is known
+    # there, otherwise by asking the cluster with check().  Without use_cache the cluster is always
+    # asked, and what it says replaces whatever was known
+    metadata = getattr(connection, "metadata", None)
+    if metadata is not None and use_cache:
+        if metadata.get(kind, connection.index, type):
+            return True
+    exists = check()
+    _remember(connection, kind, type, exists)
+    return exists
+
+def _remember(connection, kind, type, exists):
+    # only what exists is kept: anything may create the index or type at any time, so that it
+    # doesn't is never worth remembering
+    metadata = getattr(connection, "metadata", None)
+    if metadata is None:
+        return
+    if exists:
+        metadata.set(kind, connection.index, type, True)
+    else:
+        metadata.invalidate(connection.index, type if kind != "index" else None)
+
+def _written(connection, type, resp):
+    # a successful write means the index, and the type written to, now exist
+    if resp.status_code in [200, 201]:
+        _remember(connection, "index", None, True)
+        if type is not None:
+            _remember(connection, "type", type, True)
+
+def _forget(connection, type=None):
+    metadata = getattr(connection, "metadata", None)
+    if metadata is not None:
+        metadata.invalidate(connection.index, type)
+
 ####################################################################
 ## Mappings
 
-def put_mapping(connection, type=None, mapping=None, make_index=True, es_version="0.90.13"):
+# es_version, where it is taken, overrides the version of the connection (see server_version)
+
+def put_mapping(connection, type=None, mapping=None, make_index=True, es_version=None):
     if mapping is None:
         raise ESWireException("cannot put empty mapping")
     
@@ -258,62 +1215,49 @@ def put_mapping(connection, type=None, mapping=None, make_index=True, es_version
         else:
             raise ESWireException("index '" + str(connection.index) + "' does not exist")
 
-    if es_version.startswith("0.9"):
+    if _version(connection, es_version).startswith("0.9"):
         url = elasticsearch_url(connection, type, "_mapping")
-        r = _do_put(url, connection, json.dumps(mapping))
-        return r
-    elif es_version.startswith("1."):
-        url = elasticsearch_url(connection, "_mapping", type)
-        r = _do_put(url, connection, json.dumps(mapping))
-        return r
-    elif es_version.startswith("2."):
+    else:
         url = elasticsearch_url(connection, "_mapping", type)
-        r = _do_put(url, connection, json.dumps(mapping))
-        return r
+    r = _do_put(url, connection, get_codec(connection).dumpb(mapping))
+    if r.status_code == 200:
+        _remember(connection, "type", type, True)
+        _remember(connection, "mapping", type, True)
+    else:
+        _forget(connection, type)
+    return r
 
-def has_mapping(connection, type, es_version="0.90.13"):
-    if es_version.startswith("0.9"):
-        url = elasticsearch_url(connection, type, endpoint="_mapping")
-        resp = _do_get(url, connection)
-        return resp.status_code == 200
-    elif es_version.startswith("1."):
-        url = elasticsearch_url(connection, "_mapping", type)
-        resp = _do_get(url, connection)
-        return resp.status_code == 200
-    elif es_version.startswith("2."):
-        url = elasticsearch_url(connection, "_mapping", type)
-        resp = _do_get(url, connection)
+def has_mapping(connection, type, es_version=None, use_cache=True):
+    def check():
+        resp = get_mapping(connection, type, es_version)
         return resp.status_code == 200
+    return _known(connection, "mapping", type, use_cache, check)
 
-def get_mapping(connection, type, es_version="0.90.13"):
-    if es_version.startswith("0.9"):
+def get_mapping(connection, type, es_version=None):
+    if _version(connection, es_version).startswith("0.9"):
         url = elasticsearch_url(connection, type, endpoint="_mapping")
-        resp = _do_get(url, connection)
-        return resp
-    elif es_version.startswith("1."):
-        url = elasticsearch_url(connection, "_mapping", type)
-        resp = _do_get(url, connection)
-        return resp
-    elif es_version.startswith("2."):
+    else:
         url = elasticsearch_url(connection, "_mapping", type)
-        resp = _do_get(url, connection)
-        return resp
+    return _do_get(url, connection)
 
 ##########################################################
 ## Existence checks
 
-def type_exists(connection, type, es_version="0.90.13"):
-    url = elasticsearch_url(connection, type)
-    if es_version.startswith("0"):
-        resp = _do_get(url, connection)
-    else:
-        resp = _do_head(url, connection)
-    return resp.status_code == 200
+def type_exists(connection, type, es_version=None, use_cache=True):
+    def check():
+        url = elasticsearch_url(connection, type)
+        if _version(connection, es_version).startswith("0"):
+            resp = _do_get(url, connection)
+        else:
+            resp = _do_head(url, connection)
+        return resp.status_code == 200
+    return _known(connection, "type", type, use_cache, check)
 
-def index_exists(connection):
-    iurl = elasticsearch_url(connection, endpoint="_mapping")
-    resp = _do_get(iurl, connection)
-    return resp.status_code == 200
+def index_exists(connection, use_cache=True):
+    def check():
+        resp = _do_head(elasticsearch_url(connection), connection)
+        return resp.status_code == 200
+    return _known(connection, "index", None, use_cache, check)
 
 ###########################################################
 ## Index create
@@ -323,44 +1267,241 @@ def create_index(connection, mapping=None):
     if mapping is None:
         resp = _do_post(iurl, connection)
     else:
-        resp = _do_post(iurl, connection, data=json.dumps(mapping))
+        resp = _do_post(iurl, connection, data=get_codec(connection).dumpb(mapping))
+    _forget(connection)
+    if resp.status_code == 200:
+        _remember(connection, "index", None, True)
     return resp
 
 ############################################################
 ## Store records
 
+# values for the "refresh" parameter when a write has to be visible to search before it returns
+REFRESH_WAIT_FOR = "wait_for"   # ES 5.x and later: wait for the next scheduled refresh
+REFRESH_TRUE = "true"           # any version: force a refresh of the affected shards
+
+def default_refresh(connection, es_version=None):
+    """
+    The refresh to ask for where a write has to be visible to search: REFRESH_WAIT_FOR where the
+    cluster has it (5.x and later), otherwise REFRESH_TRUE
+    """
+    try:
+        major = int(_version(connection, es_version).split(".")[0])
+    except ValueError:
+        return REFRESH_TRUE
+    return REFRESH_WAIT_FOR if major >= 5 else REFRESH_TRUE
+
 def store(connection, type, record, id=None, params=None):
     url = elasticsearch_url(connection, type, endpoint=id, params=params)
     resp = None
     if id is not None:
-        resp = _do_put(url, connection, data=json.dumps(record))
+        resp = _do_put(url, connection, data=get_codec(connection).dumpb(record))
     else:
-        resp = _do_post(url, connection, data=json.dumps(record))
+        resp = _do_post(url, connection, data=get_codec(connection).dumpb(record))
+    _written(connection, type, resp)
     return resp
 
 def bulk(connection, type, records, idkey='id'):
-    data = ''
-    for r in records:
-        data += json.dumps( {'index':{'_id':r[idkey]}} ) + '\n'
-        data += json.dumps( r ) + '\n'
+    # the body is handed to requests as a generator, so it is sent chunked rather than
+    # being assembled in memory first.  That also means it can't be retried; BulkIndexer
+    # retries rejected items if the connection has a RetryPolicy
     url = elasticsearch_url(connection, type, endpoint="_bulk")
-    resp = _do_post(url, connection, data=data)
+    resp = _do_post(url, connection, data=bulk_lines(records, idkey=idkey, codec=get_codec(connection)))
+    _written(connection, type, resp)
     return resp
 
+BULK_ACTIONS = ["index", "create", "update", "delete"]
+
+def bulk_action_lines(action, record=None, id=None, type=None, index=None, codec=None):
+    if action not in BULK_ACTIONS:
+        raise ESWireException("unknown bulk action '" + str(action) + "'")
+    meta = {}
+    if id is not None:
+        meta["_id"] = id
+    if type is not None:
+        meta["_type"] = type
+    if index is not None:
+        meta["_index"] = index
+    codec = codec if codec is not None else json_codec.default()
+    lines = [codec.dumpb({action : meta}) + b"\n"]
+    if action == "delete":
+        if id is None:
+            raise ESWireException("bulk delete requires an id")
+    elif action == "update":
+        if id is None:
+            raise ESWireException("bulk update requires an id")
+        lines.append(codec.dumpb({"doc" : record}) + b"\n")
+    else:
+        lines.append(codec.dumpb(record) + b"\n")
+    return lines
+
+def bulk_lines(records, idkey='id', action="index", codec=None):
+    for r in records:
+        for line in bulk_action_lines(action, r, r.get(idkey), codec=codec):
+            yield line
+
+def unpack_bulk(requests_response):
+    j = decode(requests_response)
+    results = []
+    for item in j.get("items", []):
+        action = list(item.keys())[0]
+        info = item[action]
+        status = info.get("status")
+        error = info.get("error")
+        ok = error is None and (status is None or status < 300)
+        results.append({"action" : action, "id" : info.get("_id"), "type" : info.get("_type"),
+                        "status" : status, "ok" : ok, "error" : error})
+    return results, j.get("took", 0)
+
+class BulkResult(object):
+    def __init__(self):
+        self.items = []
+        self.requests = 0
+        self.took = 0
+
+    @property
+    def failed(self):
+        return [i for i in self.items if not i.get("ok")]
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+    def add(self, items, took=0, requests=1):
+        self.items.extend(items)
+        self.requests += requests
+        self.took += took
+
+class BulkIndexer(object):
+    """
+    Sends records to the _bulk endpoint in chunks, flushing whenever either max_docs actions
+    or max_bytes of NDJSON have been buffered, so memory use is bounded by the chunk size and
+    not by the number of records.  Every action's outcome is recorded in self.result.  With
+    refresh, closing the indexer waits once for the whole batch to be visible to search: the last
+    chunk is sent with refresh=wait_for where the cluster has it (see default_refresh), otherwise
+    the index is refreshed once at the end.
+    """
+    def __init__(self, connection, type=None, idkey="id", action="index", max_docs=1000, max_bytes=5242880, refresh=False):
+        self.connection = connection
+        self.refresh = refresh
+        self.type = type
+        self.idkey = idkey
+        self.action = action
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.result = BulkResult()
+
+        self._lines = []
+        self._actions = []
+        self._size = 0
+
+    def add(self, record=None, action=None, id=None, type=None, index=None):
+        """
+        Buffer one bulk action, and flush if that takes us over either threshold.  Returns the
+        list of item results if a flush happened, otherwise None
+        """
+        action = action if action is not None else self.action
+        if id is None and record is not None and self.idkey is not None:
+            id = record.get(self.idkey)
+        lines = bulk_action_lines(action, record, id, type, index, codec=get_codec(self.connection))
+        self._lines.append(lines)
+        self._actions.append({"action" : action, "id" : id, "type" : type if type is not None else self.type})
+        self._size += sum([len(l) for l in lines])
+        if len(self._actions) >= self.max_docs or self._size >= self.max_bytes:
+            return self.flush()
+        return None
+
+    def index(self, records):
+        for r in records:
+            self.add(r)
+        return self.close()
+
+    def flush(self, refresh=None):
+        """
+        Send what is buffered, asking for the given refresh (see REFRESH_WAIT_FOR) if there is one
+        """
+        if len(self._actions) == 0:
+            return []
+        lines, actions = self._lines, self._actions
+        self._lines, self._actions, self._size = [], [], 0
+
+        items, took, sent = self._send(lines, actions, refresh)
+        requests = 1
+
+        # resend just the items the cluster was too busy for.  If the request as a whole failed,
+        # _do_request has already done any retrying of it
+        policy = getattr(self.connection, "retry", None)
+        attempt = 1
+        while sent and policy is not None:
+            rejected = [i for i, item in enumerate(items) if item.get("status") in policy.statuses]
+            if len(rejected) == 0:
+                break
+            if attempt >= policy.max_attempts:
+                policy.record(gave_up=len(rejected))
+                break
+            policy.wait(attempt)
+            policy.record(bulk_items=len(rejected))
+            attempt += 1
+            retried, retook, sent = self._send([lines[i] for i in rejected], [actions[i] for i in rejected], refresh)
+            for i, item in zip(rejected, retried):
+                items[i] = item
+            took += retook
+            requests += 1
+
+        self.result.add(items, took, requests)
+        return items
+
+    def _send(self, lines, actions, refresh=None):
+        params = {"refresh" : refresh} if refresh is not None else None
+        url = elasticsearch_url(self.connection, self.type, endpoint="_bulk", params=params)
+        resp = _do_post(url, self.connection, data=b"".join([l for ls in lines for l in ls]))
+        if resp.status_code != 200:
+            # the whole request failed, so every action in it failed
+            items = []
+            for a in actions:
+                a = a.copy()
+                a.update({"status" : resp.status_code, "ok" : False, "error" : resp.text})
+                items.append(a)
+            return items, 0, False
+        items, took = unpack_bulk(resp)
+        return items, took, True
+
+    def close(self):
+        if self.refresh and len(self._actions) > 0 and default_refresh(self.connection) == REFRESH_WAIT_FOR:
+            # the last chunk waits for the next scheduled refresh, rather than forcing one
+            self.flush(REFRESH_WAIT_FOR)
+            return self.result
+        self.flush()
+        if self.refresh and self.result.requests > 0:
+            # one refresh at the end makes everything we sent visible to search, rather than
+            # refreshing on every chunk
+            refresh(self.connection)
+        return self.result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
 ############################################################
 ## Delete records
 
 def delete(connection, type=None, id=None):
     url = elasticsearch_url(connection, type, endpoint=id)
     resp = _do_delete(url, connection)
+    if id is None:
+        # the whole type or index has gone
+        _forget(connection, type)
     return resp
 
-def delete_by_query(connection, type, query, es_version="0.90.13"):
+def delete_by_query(connection, type, query, es_version=None):
     url = elasticsearch_url(connection, type, endpoint="_query")
-    if "query" in query and es_version.startswith("0.9"):
+    if "query" in query and _version(connection, es_version).startswith("0.9"):
         # we have to unpack the query, as the endpoint covers that
         query = query["query"]
-    resp = _do_delete(url, connection, data=json.dumps(query))
+    resp = _do_delete(url, connection, data=get_codec(connection).dumpb(query))
     return resp
 
 ##############################################################
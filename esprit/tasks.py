@@ -1,26 +1,194 @@
 from esprit import raw, models
-import json, sys
+import sys, io, gzip, time, math, threading, multiprocessing, logging
+import copy as copy_module
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+log = logging.getLogger(__name__)
 
 class ScrollException(Exception):
     pass
 
-def copy(source_conn, source_type, target_conn, target_type, limit=None, batch_size=1000, method="POST", q=None):
+class CopyStats(object):
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = []
+        self.started = time.time()
+        self.finished = None
+
+    def record(self, count, failed):
+        self.written += count - len(failed)
+        self.batches += 1
+        self.failed.extend(failed)
+        log.debug("wrote batch of %d with %d errors", count, len(failed))
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "read {r}, wrote {w} in {b} batches, {f} failed, {s:.1f}s ({p:.1f} docs/s)".format(
+            r=self.read, w=self.written, b=self.batches, f=len(self.failed), s=self.elapsed, p=self.rate)
+
+def copy(source_conn, source_type, target_conn, target_type, limit=None, batch_size=1000, method="POST", q=None,
+         workers=None, queue_size=None, processes=False, slices=None):
+    """
+    Copy records from one type to another with bulk requests.  By default each page is read and
+    then written in turn; give a number of workers to have the source read into a bounded queue
+    of batches which that many writer threads (or processes) drain concurrently.  Giving a number
+    of slices reads the source with a sliced scroll instead of paging through it
+    """
     if q is None:
         q = models.QueryBuilder.match_all()
-    batch = []
-    for r in iterate(source_conn, source_type, q, page_size=batch_size, limit=limit, method=method):
-        batch.append(r)
-        if len(batch) >= batch_size:
-            print("writing batch of", len(batch))
-            raw.bulk(target_conn, target_type, batch)
-            batch = []
-    if len(batch) > 0:
-        print("writing batch of", len(batch))
-        raw.bulk(target_conn, target_type, batch)
+    if slices is not None:
+        source = scroll(source_conn, source_type, q, page_size=batch_size, limit=limit, slices=slices)
+    else:
+        source = iterate(source_conn, source_type, q, page_size=batch_size, limit=limit, method=method)
+    if workers is None:
+        return _copy_serial(source, target_conn, target_type, batch_size)
+    return _copy_pipelined(source, target_conn, target_type, batch_size, workers, queue_size, processes)
+
+def _copy_serial(source, target_conn, target_type, batch_size):
+    stats = CopyStats()
+    indexer = raw.BulkIndexer(target_conn, target_type, max_docs=batch_size)
+    for r in source:
+        stats.read += 1
+        items = indexer.add(r)
+        if items is not None:
+            stats.record(len(items), [i for i in items if not i.get("ok")])
+    items = indexer.flush()
+    if len(items) > 0:
+        stats.record(len(items), [i for i in items if not i.get("ok")])
+    stats.finish()
+    return stats
+
+def _copy_pipelined(source, target_conn, target_type, batch_size, workers, queue_size, processes):
+    if queue_size is None:
+        queue_size = workers * 2
+
+    # the batch queue is bounded, so the reader blocks (rather than filling memory) whenever
+    # the writers fall behind
+    if processes:
+        batches = multiprocessing.Queue(queue_size)
+        results = multiprocessing.Queue()
+        writers = [multiprocessing.Process(target=_copy_writer, args=(target_conn, target_type, batches, results, True))
+                   for _ in range(workers)]
+    else:
+        batches = Queue.Queue(queue_size)
+        results = Queue.Queue()
+        writers = [threading.Thread(target=_copy_writer, args=(target_conn, target_type, batches, results, False))
+                   for _ in range(workers)]
+
+    stats = CopyStats()
+    def collect():
+        while True:
+            res = results.get()
+            if res is None:
+                break
+            stats.record(*res)
+    collector = threading.Thread(target=collect)
+
+    for w in writers:
+        w.daemon = True
+        w.start()
+    collector.daemon = True
+    collector.start()
+
+    try:
+        batch = []
+        for r in source:
+            stats.read += 1
+            batch.append(r)
+            if len(batch) >= batch_size:
+                batches.put(batch)
+                batch = []
+        if len(batch) > 0:
+            batches.put(batch)
+    finally:
+        for _ in writers:
+            batches.put(None)
+        for w in writers:
+            w.join()
+        results.put(None)
+        collector.join()
+        stats.finish()
+    return stats
+
+def _copy_writer(target_conn, target_type, batches, results, own_connection):
+    if own_connection:
+        # a forked process mustn't share the parent's pooled sockets, so copy the connection,
+        # which gives it a pool of its own
+        target_conn = copy_module.copy(target_conn)
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        try:
+            result = raw.BulkIndexer(target_conn, target_type, max_docs=len(batch) + 1).index(batch)
+            results.put((len(batch), result.failed))
+        except Exception as e:
+            results.put((len(batch), [{"ok" : False, "error" : str(e)}]))
 
 # 2018-12-19 TD : raise keepalive value to '10m'
 # def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="1m"):
-def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m"):
+def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m", slices=None, workers=None, ordered=False,
+           stream=False, prefetch=None):
+    """
+    Scroll over all the records matching the query.  If slices is given (ES 5.x and later), that
+    many scroll cursors are opened with the "slice" parameter and consumed concurrently by a pool
+    of workers (one per slice unless workers is given), and their records merged into this one
+    generator: in slice order if ordered is True, otherwise in whatever order the pages arrive.
+
+    keepalive may be a fixed ES time value, KEEPALIVE_AUTO, or an AdaptiveKeepalive.  The scroll
+    context is cleared when the generator finishes, fails, is closed or is garbage collected, and
+    is listed in scroll_registry for as long as it is open.
+
+    With stream (needs ijson), each page is parsed as it is read, so that only one record at a
+    time is held in memory rather than a whole page.  Sliced scrolls hand whole pages between
+    threads, so don't stream.
+
+    With prefetch, up to that many pages are fetched in the background ahead of the one being
+    consumed.  Sliced scrolls already read ahead, and streamed pages have to be read before the
+    next can be asked for, so prefetch doesn't apply to either
+    """
+    q = _scroll_query(q, page_size)
+
+    if slices is not None and slices > 1:
+        pages = _sliced_scroll_pages(conn, type, q, keepalive, slices, workers, ordered)
+    else:
+        pages = _scroll_pages(conn, type, q, keepalive, stream=stream)
+        if prefetch and not stream:
+            pages = prefetch_pages(pages, prefetch, limit)
+
+    counter = 0
+    try:
+        for results in pages:
+            for r in results:
+                # apply the limit
+                if limit is not None and counter >= int(limit):
+                    return
+                counter += 1
+                yield r
+            # apply the limit (again), so that we don't ask for a page we won't use
+            if limit is not None and counter >= int(limit):
+                return
+    finally:
+        pages.close()
+
+def _scroll_query(q, page_size):
     if q is not None:
         q = q.copy()
     if q is None:
@@ -29,88 +197,406 @@ def scroll(conn, type, q=None, page_size=1000, limit=None, keepalive="10m"):
         q["size"] = page_size
     if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
         q["sort"] = [{"id" : {"order" : "asc"}}]
+    return q
+
+def _scroll_pages(conn, type, q, keepalive, stream=False):
+    if keepalive == KEEPALIVE_AUTO:
+        keepalive = AdaptiveKeepalive()
 
-    resp = raw.initialise_scroll(conn, type, q, keepalive)
+    resp = raw.initialise_scroll(conn, type, q, str(keepalive), stream=stream)
     if resp.status_code != 200:
         # something went wrong initialising the scroll
         raise ScrollException("Unable to initialise scroll - could be your mappings are broken")
 
     # otherwise, carry on
-    results, scroll_id = raw.unpack_scroll(resp)
+    results, scroll_id = _unpack_scroll_page(resp, stream, None)
+    token = scroll_registry.register(conn, type, scroll_id, str(keepalive))
+    timed_out = False
+    try:
+        idle_since = time.time()
+        yield results
 
-    counter = 0
-    for r in results:
-        # apply the limit
-        if limit is not None and counter >= int(limit):
-            break
-        counter += 1
-        yield r
-
-    while True:
-        # apply the limit
-        if limit is not None and counter >= int(limit):
-            break
+        while True:
+            scroll_id = _current_scroll_id(results, scroll_id)
+            if stream and results.count == 0:
+                break
 
-        sresp = raw.scroll_next(conn, scroll_id, keepalive=keepalive)
-        if raw.scroll_timedout(sresp):
-            raise ScrollException("scroll timed out - you probably need to raise the keepalive value")
-        results = raw.unpack_result(sresp)
+            # the context has been idle since the last page came back; that's what the keepalive has to cover
+            if isinstance(keepalive, AdaptiveKeepalive):
+                keepalive.observe(time.time() - idle_since)
+            sresp = raw.scroll_next(conn, scroll_id, keepalive=str(keepalive), stream=stream)
+            if raw.scroll_timedout(sresp):
+                timed_out = True    # the context has already gone, so there is nothing to clear
+                raise ScrollException("scroll timed out - you probably need to raise the keepalive value")
+            if sresp.status_code != 200:
+                # anything else would read as an empty page, and end the scroll early
+                raise ScrollException("scroll failed with status " + str(sresp.status_code) + ": " + sresp.text)
+            results, scroll_id = _unpack_scroll_page(sresp, stream, scroll_id)
+            idle_since = time.time()
+            scroll_registry.update(token, scroll_id, str(keepalive))
 
-        if len(results) == 0:
-            break
-        for r in results:
-            # apply the limit (again)
-            if limit is not None and counter >= int(limit):
+            # a streamed page can't be counted until it has been read, so that is checked next time round
+            if not stream and len(results) == 0:
                 break
-            counter += 1
-            yield r
+            yield results
+    finally:
+        # whether the scroll is exhausted, failed, or was closed or garbage collected part way through,
+        # free the context now rather than leaving it pinned on the cluster until the keepalive runs out
+        scroll_registry.unregister(token)
+        scroll_id = _current_scroll_id(results, scroll_id) if not timed_out else None
+        if scroll_id is not None:
+            try:
+                raw.clear_scroll(conn, scroll_id)
+            except Exception:
+                # don't hide whatever brought us here; the context will time out eventually
+                pass
 
-def iterate(conn, type, q, page_size=1000, limit=None, method="POST"):
-    q = q.copy()
-    q["size"] = page_size
-    q["from"] = 0
-    if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
-        q["sort"] = [{"id" : {"order" : "asc"}}]
+def _unpack_scroll_page(resp, stream, scroll_id):
+    if stream:
+        # the new scroll id isn't known until the page starts to be read
+        return raw.StreamedHits(resp, sources=True), scroll_id
+    return raw.unpack_scroll(resp)
+
+def _current_scroll_id(results, scroll_id):
+    if isinstance(results, raw.StreamedHits) and results.scroll_id is not None:
+        return results.scroll_id
+    return scroll_id
+
+KEEPALIVE_AUTO = "auto"
+
+class AdaptiveKeepalive(object):
+    """
+    A scroll keepalive which tracks how long the scroll context is left idle between pages, and
+    asks for a multiple of the longest idle time seen so far (within the given bounds, in seconds),
+    rather than a fixed period that has to be long enough for the slowest consumer
+    """
+    def __init__(self, initial=600, minimum=60, maximum=1800, factor=4):
+        self.current = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.longest = 0.0
+
+    def observe(self, idle):
+        self.longest = max(self.longest, idle)
+        self.current = int(min(self.maximum, max(self.minimum, math.ceil(self.longest * self.factor))))
+
+    def __str__(self):
+        return str(self.current) + "s"
+
+class ScrollRegistry(object):
+    """
+    Keeps track of the scroll contexts this process has open on the cluster
+    """
+    def __init__(self):
+        self._scrolls = {}
+        self._lock = threading.Lock()
+        self._counter = 0
+
+    def register(self, conn, type, scroll_id, keepalive):
+        with self._lock:
+            self._counter += 1
+            now = time.time()
+            self._scrolls[self._counter] = {
+                "host" : conn.host,
+                "index" : conn.index,
+                "type" : type,
+                "scroll_id" : scroll_id,
+                "keepalive" : keepalive,
+                "opened" : now,
+                "last_page" : now,
+                "pages" : 1
+            }
+            return self._counter
+
+    def update(self, token, scroll_id, keepalive):
+        with self._lock:
+            info = self._scrolls.get(token)
+            if info is not None:
+                info["scroll_id"] = scroll_id
+                info["keepalive"] = keepalive
+                info["last_page"] = time.time()
+                info["pages"] += 1
+
+    def unregister(self, token):
+        with self._lock:
+            self._scrolls.pop(token, None)
+
+    def count(self):
+        with self._lock:
+            return len(self._scrolls)
+
+    def open_scrolls(self):
+        with self._lock:
+            return [info.copy() for info in self._scrolls.values()]
+
+scroll_registry = ScrollRegistry()
+
+class _PagesDone(object):
+    pass
+
+class _PagesError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+def _put_unless_stopped(output, item, stop):
+    # wait for room in the queue, but give up if the consumer has gone away
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            continue
+    return False
+
+def prefetch_pages(pages, depth=1, limit=None):
+    """
+    Run a generator of pages in a background thread, which fetches up to depth pages ahead of
+    the consumer, so that the next request is in flight while the current page is processed.  If
+    limit is given, no more pages are fetched once that many records have been
+    """
+    buffer = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        # the pages generator is only ever run (and closed) in this thread
+        count = 0
+        try:
+            for results in pages:
+                if not _put_unless_stopped(buffer, results, stop):
+                    return
+                count += len(results)
+                if limit is not None and count >= int(limit):
+                    break
+            _put_unless_stopped(buffer, _PagesDone(), stop)
+        except Exception as e:
+            _put_unless_stopped(buffer, _PagesError(e), stop)
+        finally:
+            pages.close()
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _PagesError):
+                raise item.exception
+            if isinstance(item, _PagesDone):
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def _sliced_scroll_pages(conn, type, q, keepalive, slices, workers, ordered):
+    stop = threading.Event()
+
+    todo = Queue.Queue()
+    for i in range(slices):
+        todo.put(i)
+
+    # the output queues are bounded, so a slice's worker waits rather than reading ahead without limit
+    if ordered:
+        outputs = [Queue.Queue(2) for _ in range(slices)]
+    else:
+        shared = Queue.Queue(slices * 2)
+        outputs = [shared] * slices
+
+    def work():
+        while not stop.is_set():
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            sq = q.copy()
+            sq["slice"] = {"id" : i, "max" : slices}
+            pages = _scroll_pages(conn, type, sq, keepalive)
+            try:
+                for results in pages:
+                    if stop.is_set():
+                        break
+                    _put_unless_stopped(outputs[i], results, stop)
+                _put_unless_stopped(outputs[i], _PagesDone(), stop)
+            except Exception as e:
+                _put_unless_stopped(outputs[i], _PagesError(e), stop)
+            finally:
+                pages.close()
+
+    threads = [threading.Thread(target=work) for _ in range(workers if workers is not None else slices)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        remaining = slices
+        current = 0
+        while remaining > 0:
+            item = outputs[current].get()
+            if isinstance(item, _PagesError):
+                raise item.exception
+            if isinstance(item, _PagesDone):
+                remaining -= 1
+                if ordered:
+                    current += 1
+                continue
+            yield item
+    finally:
+        # tell the workers to stop; each one clears its own scroll on the way out
+        stop.set()
+        for t in threads:
+            t.join()
+
+PAGING_SEARCH_AFTER = "search_after"
+PAGING_FROM_SIZE = "from_size"
+
+def default_paging(conn):
+    """
+    search_after where the cluster has it (ES 5.x and later), otherwise from/size
+    """
+    return paging_for_version(raw.server_version(conn))
+
+def paging_for_version(es_version):
+    try:
+        major = int(es_version.split(".")[0])
+    except ValueError:
+        return PAGING_FROM_SIZE
+    return PAGING_SEARCH_AFTER if major >= 5 else PAGING_FROM_SIZE
+
+def iterate(conn, type, q, page_size=1000, limit=None, method="POST", paging=None, stream=False, prefetch=None):
+    """
+    Page through all the records matching the query.  Where the cluster has it (see
+    default_paging), each page carries on from the sort values of the last hit of the one before
+    (search_after), which costs the same at any depth; otherwise, or with
+    paging=PAGING_FROM_SIZE, the old from/size paging is used.  With stream
+    (needs ijson), each page is parsed one record at a time as it is read.  Otherwise, prefetch
+    fetches up to that many pages in the background ahead of the one being consumed
+    """
+    if paging is None:
+        paging = default_paging(conn)
+
+    def search(query):
+        resp = raw.search(conn, type=type, query=query, method=method, stream=stream)
+        if resp.status_code != 200:
+            raise raw.ESWireException("search failed with status " + str(resp.status_code) + ": " + resp.text)
+        if stream:
+            return raw.StreamedHits(resp)
+        return raw.decode(resp)
+    pages = iterate_pages(search, q, page_size=page_size, paging=paging)
+    if prefetch and not stream:
+        pages = prefetch_pages(pages, prefetch, limit)
     counter = 0
+    try:
+        for hits in pages:
+            for h in hits:
+                # apply the limit
+                if limit is not None and counter >= int(limit):
+                    return
+                counter += 1
+                yield raw.unpack_hit(h)
+            # apply the limit (again), so that we don't ask for a page we won't use
+            if limit is not None and counter >= int(limit):
+                return
+    finally:
+        pages.close()
+
+def iterate_pages(search, q, page_size=1000, paging=PAGING_SEARCH_AFTER):
+    """
+    Yield pages of raw hits for the query, where search is a function which takes a query dict
+    and returns the search response as json, or as raw.StreamedHits.  An error response is raised
+    as an ESWireException rather than taken for the end of the results
+    """
+    q = _paging_query(q, page_size, paging)
     while True:
-        # apply the limit
-        if limit is not None and counter >= int(limit):
-            break
-        
-        res = raw.search(conn, type=type, query=q, method=method)
-        rs = raw.unpack_result(res)
-        
-        if len(rs) == 0:
+        res = search(q)
+        if isinstance(res, raw.StreamedHits):
+            # streamed hits can only be counted once they have been read
+            hits = res
+            yield hits
+            count, last = hits.count, hits.last
+        else:
+            if "error" in res:
+                raise raw.ESWireException(res["error"])
+            hits = res.get("hits", {}).get("hits", [])
+            count, last = len(hits), hits[-1] if len(hits) > 0 else None
+            if count > 0:
+                yield hits
+        if count == 0:
             break
-        for r in rs:
-            # apply the limit (again)
-            if limit is not None and counter >= int(limit):
-                break
-            counter += 1
-            yield r
-        q["from"] += page_size
+        if paging == PAGING_SEARCH_AFTER:
+            q["search_after"] = last.get("sort")
+        else:
+            q["from"] += page_size
 
-def dump(conn, type, q=None, page_size=1000, limit=None, method="POST", out=None, transform=None):
+def _paging_query(q, page_size, paging):
+    # the query for the first page
+    q = q.copy()
+    q["size"] = page_size
+    if paging == PAGING_SEARCH_AFTER:
+        q["sort"] = _with_tiebreaker(q.get("sort"))
+        q.pop("from", None)
+        q.pop("search_after", None)
+    elif paging == PAGING_FROM_SIZE:
+        if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
+            q["sort"] = [{"id" : {"order" : "asc"}}]
+        q["from"] = 0
+    else:
+        raise ValueError("unknown paging mode '" + str(paging) + "'")
+    return q
+
+def _with_tiebreaker(sort):
+    # search_after needs a unique field at the end of the sort, so make sure id is always in there
+    if sort is None:
+        return [{"id" : {"order" : "asc"}}]
+    if not isinstance(sort, list):
+        sort = [sort]
+    for s in sort:
+        if s == "id" or (isinstance(s, dict) and "id" in s):
+            return sort
+    return sort + [{"id" : {"order" : "asc"}}]
+
+def dump(conn, type, q=None, page_size=1000, limit=None, method="POST", out=None, transform=None, paging=None, stream=False):
+    """
+    Write the matching records to out (stdout by default) one per line, a page's worth at a time.
+    See the export module for writing to files
+    """
     q = q if q is not None else {"query" : {"match_all" : {}}}
     out = out if out is not None else sys.stdout
-    for record in iterate(conn, type, q, page_size=page_size, limit=limit, method=method):
+    codec = raw.get_codec(conn)
+    lines = []
+    for record in iterate(conn, type, q, page_size=page_size, limit=limit, method=method, paging=paging, stream=stream):
         if transform is not None:
             record = transform(record)
-        out.write(json.dumps(record))
+        lines.append(codec.dumps(record))
+        if len(lines) >= page_size:
+            out.write("\n".join(lines) + "\n")
+            lines = []
+    if len(lines) > 0:
+        out.write("\n".join(lines) + "\n")
 
 class JSONListWriter(object):
-    def __init__(self, path):
-        self.f = open(path, "wb")
-        self.f.write("[")
+    """
+    Writes already serialised records (text or utf-8 bytes) to a file as a json list, through a
+    buffer of buffer_size bytes, and gzipped if compress is True
+    """
+    def __init__(self, path, compress=False, buffer_size=1024 * 1024):
+        if compress:
+            self.f = gzip.GzipFile(path, "wb")
+        else:
+            self.f = io.open(path, "wb", buffering=buffer_size)
+        self.f.write(b"[")
         self.first = True
 
     def write(self, serialised_json_object):
+        if not isinstance(serialised_json_object, bytes):
+            serialised_json_object = serialised_json_object.encode("utf-8")
         if self.first:
             self.first = False
         else:
-            self.f.write(",")
+            self.f.write(b",")
         self.f.write(serialised_json_object)
 
     def close(self):
-        self.f.write("]")
+        self.f.write(b"]")
         self.f.close()
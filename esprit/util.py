@@ -1,4 +1,7 @@
 from datetime import datetime
 
-def now():
-    return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+def now(subsecond=False):
+    n = datetime.utcnow()
+    if subsecond:
+        return n.strftime("%Y-%m-%dT%H:%M:%S.") + "{ms:03d}Z".format(ms=n.microsecond // 1000)
+    return n.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -7,6 +7,11 @@ setup(
     install_requires = [
         "requests",
     ],
+    extras_require = {
+        "aio" : ["aiohttp"],
+        "orjson" : ["orjson"],
+        "stream" : ["ijson"],
+    },
     url = 'http://cottagelabs.com/',
     author = 'Cottage Labs',
     author_email = 'us@cottagelabs.com',